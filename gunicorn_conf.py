@@ -0,0 +1,76 @@
+"""
+Production entry point for running the API on many cores:
+
+    gunicorn -c gunicorn_conf.py main:app
+
+The app is imported once in the master before workers fork (preload_app), so
+the station tables, WSDL and route code are loaded a single time and shared
+copy-on-write with every worker instead of being rebuilt per process. The
+database schema is created once in the master, in on_starting, which gunicorn
+runs after preloading the app. Workers then drop the database and HTTP
+connections they inherited so each opens its own.
+
+What is per worker and what is shared:
+    - Darwin request budgets and spend are shared through UPSTREAM_BUDGET_DB,
+      which this config points at a file in the temp directory by default.
+      Without it every worker would get the full budget.
+    - Each worker precomputes the routes it is asked for most, drawing on the
+      shared route-precompute budget, so adding workers doesn't add Darwin calls.
+    - Board, service and route caches are per worker, so a cold key may be
+      fetched once by each worker.
+    - Live update pollers are per worker: a service watched by clients on N
+      workers is polled N times. Keep WEB_CONCURRENCY modest if many clients
+      watch the same services.
+
+Settings:
+    PORT                 port to bind (default 8000)
+    WEB_CONCURRENCY      number of worker processes (default: CPU count)
+    GUNICORN_TIMEOUT     seconds before an unresponsive worker is restarted (default 60)
+    UPSTREAM_BUDGET_DB   SQLite file used to share Darwin request budgets between workers
+    TRUSTED_PROXY_HOPS   proxies in front of the app that append to X-Forwarded-For (default 1)
+
+Per-user upstream budgets are keyed on the signed-in user, or else the client
+address. Behind Render's proxy every request arrives from the proxy, so the
+address is read from X-Forwarded-For. Clients can send that header themselves
+and the proxy only appends to it, so just the last TRUSTED_PROXY_HOPS entries
+are trusted. Set it to 0 when the app is reachable without a proxy, and raise
+it for each extra proxy that appends to the header.
+
+Probes: GET /health/live for liveness and GET /health/ready for readiness.
+"""
+import gc
+import os
+import tempfile
+import multiprocessing
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn_worker.UvicornWorker"
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+preload_app = True
+
+# Set before the app is preloaded: main.py leaves schema creation to on_starting,
+# every worker draws from one upstream budget, and clients are identified behind Render's proxy
+os.environ["SKIP_DB_INIT"] = "1"
+os.environ.setdefault("UPSTREAM_BUDGET_DB", os.path.join(tempfile.gettempdir(), "journey-planner-upstream-budget.db"))
+os.environ.setdefault("TRUSTED_PROXY_HOPS", "1")
+
+
+def on_starting(server):
+    from models.database import init_db
+    init_db()
+
+
+def pre_fork(server, worker):
+    # Moving everything loaded so far out of the collector's reach, so collections
+    # in workers don't write to (and un-share) the pages inherited from the master
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    from models.database import engine
+    from services.train_schedule_fetcher import fetcher
+
+    # Connections opened by the master must not be shared between processes
+    engine.dispose(close=False)
+    fetcher.reset_after_fork()
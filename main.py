@@ -1,15 +1,19 @@
+import os
 from fastapi import FastAPI
 from routers import train_routes
 from fastapi.middleware.cors import CORSMiddleware
 from routers import itinerary_routes
-from models.database import Base, engine
+from models.database import init_db
 from routers import auth_routes
 from routers import user_routes
 from routers import station_routes
 from routers import places_routes
 from routers import journey_routes
+from routers import health_routes
 
-Base.metadata.create_all(bind=engine)
+# gunicorn_conf.py creates the schema once in the master and sets SKIP_DB_INIT for the app
+if not os.getenv("SKIP_DB_INIT"):
+    init_db()
 
 app = FastAPI()
 
@@ -20,6 +24,7 @@ app.include_router(user_routes.router)
 app.include_router(station_routes.router)
 app.include_router(places_routes.router)
 app.include_router(journey_routes.router)
+app.include_router(health_routes.router)
 
 app.add_middleware(
     CORSMiddleware,
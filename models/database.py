@@ -17,6 +17,14 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
+def init_db():
+    """
+    Create any missing tables. Run once per deployment, not once per worker.
+    """
+    # Importing the models so their tables are registered on Base
+    from models import itinerary, user
+    Base.metadata.create_all(bind=engine)
+
 # Dependency to be used in FastAPI routes
 def get_db():
     db = SessionLocal()
@@ -0,0 +1,30 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from sqlalchemy import text
+from models.database import engine
+from services.train_schedule_fetcher import fetcher
+
+router = APIRouter(prefix="/health", tags=["Health"])
+
+# Liveness: the worker is up and serving requests
+@router.get("/live")
+def liveness():
+    return {"status": "ok"}
+
+# Readiness: the database is reachable and station data is loaded
+@router.get("/ready")
+def readiness():
+    checks = {"stations": bool(fetcher.station_map)}
+
+    try:
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+        checks["database"] = True
+    except Exception:
+        checks["database"] = False
+
+    status_code = 200 if all(checks.values()) else 503
+    return JSONResponse(
+        status_code=status_code,
+        content={"status": "ok" if status_code == 200 else "unavailable", "checks": checks}
+    )
@@ -1,12 +1,16 @@
-from fastapi import APIRouter, Query, HTTPException
-from services.train_schedule_fetcher import TrainScheduleFetcher
+from fastapi import APIRouter, Query, HTTPException, Request
+from services.train_schedule_fetcher import fetcher
+from services.route_cache import RouteCache
+from services.upstream_governor import upstream_caller
+from utils.upstream import raise_if_unavailable, caller_identity
 from datetime import datetime
 
 router = APIRouter()
-fetcher = TrainScheduleFetcher()
 
 TRANSFER_BUFFER_MINUTES = 5
 
+NO_ROUTE_DETAIL = "No direct or indirect route found with valid direction and timing."
+
 def time_to_minutes(time_str: str) -> int:
     t = datetime.strptime(time_str, "%H:%M").time()
     return t.hour * 60 + t.minute
@@ -40,160 +44,218 @@ def inject_origin_if_missing(origin_crs, origin_name, scheduled_time, estimated_
             calling_points.insert(0, injected)
     return calling_points
 
-@router.get("/optimal-route")
-def get_optimal_route(from_station: str = Query(..., alias="from"), to_station: str = Query(..., alias="to")):
+def find_optimal_route(from_station: str, to_station: str):
+    """
+    Search direct and one-change journeys from the live boards and return the earliest arrival.
+    """
     try:
-        schedule_from = fetcher.fetch_schedule(from_station)
+        # A lookup shed by the upstream budget ends the search with a 503, unless a
+        # route was already found; that one is returned marked partial (see below)
+        schedule_from = raise_if_unavailable(fetcher.fetch_schedule(from_station))
         if "error" in schedule_from:
             raise HTTPException(status_code=400, detail=schedule_from["error"])
 
         best_routes = []
+        partial = False
+
+        try:
+            # Collecting all valid direct journeys
+            for service in schedule_from["departures"]:
+                details = raise_if_unavailable(fetcher.fetch_service_details(
+                    service_id=service["serviceID"],
+                    origin_name=service["origin"],
+                    scheduled_time=service["scheduledDeparture"],
+                    estimated_time=service["estimatedDeparture"],
+                    platform=service["platform"]
+                ))
 
-        # Collecting all valid direct journeys
-        for service in schedule_from["departures"]:
-            details = fetcher.fetch_service_details(
-                service_id=service["serviceID"],
-                origin_name=service["origin"],
-                scheduled_time=service["scheduledDeparture"],
-                estimated_time=service["estimatedDeparture"],
-                platform=service["platform"]
-            )
-
-            calling_points = inject_origin_if_missing(
-                origin_crs=from_station,
-                origin_name=service["origin"],
-                scheduled_time=service["scheduledDeparture"],
-                estimated_time=service["estimatedDeparture"],
-                platform=service["platform"],
-                calling_points=details.get("callingPoints", [])
-            )
-
-            crs_list = [cp["crs"] for cp in calling_points]
-            if to_station in crs_list:
-                if from_station in crs_list and crs_list.index(from_station) >= crs_list.index(to_station):
-                    continue
-
-                arrival_cp = next(cp for cp in calling_points if cp["crs"] == to_station)
-                best_routes.append({
-                    "type": "direct",
-                    "legs": [{
-                        "from": from_station,
-                        "to": to_station,
-                        "departure": service["scheduledDeparture"],
-                        "arrival": arrival_cp["scheduledTime"],
-                        "platform": service["platform"],
-                        "operator": service["operator"],
-                        "callingPoints": calling_points
-                    }]
-                })
-
-        # Collecting all valid 1-transfer journeys
-        for service in schedule_from["departures"]:
-            details_a = fetcher.fetch_service_details(
-                service_id=service["serviceID"],
-                origin_name=service["origin"],
-                scheduled_time=service["scheduledDeparture"],
-                estimated_time=service["estimatedDeparture"],
-                platform=service["platform"]
-            )
-
-            calling_points_a = inject_origin_if_missing(
-                origin_crs=from_station,
-                origin_name=service["origin"],
-                scheduled_time=service["scheduledDeparture"],
-                estimated_time=service["estimatedDeparture"],
-                platform=service["platform"],
-                calling_points=details_a.get("callingPoints", [])
-            )
-
-            crs_list_a = [cp["crs"] for cp in calling_points_a]
-            for cp in calling_points_a:
-                transfer_crs = cp["crs"]
-                arrival_time_str = cp.get("scheduledTime")
-                if not arrival_time_str:
-                    continue
-
-                if from_station in crs_list_a and transfer_crs in crs_list_a:
-                    if crs_list_a.index(from_station) >= crs_list_a.index(transfer_crs):
+                calling_points = inject_origin_if_missing(
+                    origin_crs=from_station,
+                    origin_name=service["origin"],
+                    scheduled_time=service["scheduledDeparture"],
+                    estimated_time=service["estimatedDeparture"],
+                    platform=service["platform"],
+                    calling_points=details.get("callingPoints", [])
+                )
+
+                crs_list = [cp["crs"] for cp in calling_points]
+                if to_station in crs_list:
+                    if from_station in crs_list and crs_list.index(from_station) >= crs_list.index(to_station):
                         continue
 
-                try:
-                    arrival_minutes = time_to_minutes(arrival_time_str)
-                except:
-                    continue
+                    arrival_cp = next(cp for cp in calling_points if cp["crs"] == to_station)
+                    best_routes.append({
+                        "type": "direct",
+                        "legs": [{
+                            "from": from_station,
+                            "to": to_station,
+                            "departure": service["scheduledDeparture"],
+                            "arrival": arrival_cp["scheduledTime"],
+                            "platform": service["platform"],
+                            "operator": service["operator"],
+                            "serviceID": service["serviceID"],
+                            "callingPoints": calling_points
+                        }]
+                    })
+
+            # Collecting all valid 1-transfer journeys
+            for service in schedule_from["departures"]:
+                details_a = raise_if_unavailable(fetcher.fetch_service_details(
+                    service_id=service["serviceID"],
+                    origin_name=service["origin"],
+                    scheduled_time=service["scheduledDeparture"],
+                    estimated_time=service["estimatedDeparture"],
+                    platform=service["platform"]
+                ))
 
-                schedule_b = fetcher.fetch_schedule(transfer_crs)
-                if "departures" not in schedule_b:
-                    continue
+                calling_points_a = inject_origin_if_missing(
+                    origin_crs=from_station,
+                    origin_name=service["origin"],
+                    scheduled_time=service["scheduledDeparture"],
+                    estimated_time=service["estimatedDeparture"],
+                    platform=service["platform"],
+                    calling_points=details_a.get("callingPoints", [])
+                )
 
-                for service_b in schedule_b["departures"]:
-                    departure_b_str = service_b.get("scheduledDeparture")
-                    if not departure_b_str:
+                crs_list_a = [cp["crs"] for cp in calling_points_a]
+                for cp in calling_points_a:
+                    transfer_crs = cp["crs"]
+                    arrival_time_str = cp.get("scheduledTime")
+                    if not arrival_time_str:
                         continue
 
-                    try:
-                        departure_minutes = time_to_minutes(departure_b_str)
-                        if departure_minutes < arrival_minutes + TRANSFER_BUFFER_MINUTES:
+                    if from_station in crs_list_a and transfer_crs in crs_list_a:
+                        if crs_list_a.index(from_station) >= crs_list_a.index(transfer_crs):
                             continue
+
+                    try:
+                        arrival_minutes = time_to_minutes(arrival_time_str)
                     except:
                         continue
 
-                    details_b = fetcher.fetch_service_details(
-                        service_id=service_b["serviceID"],
-                        origin_name=service_b["origin"],
-                        scheduled_time=service_b["scheduledDeparture"],
-                        estimated_time=service_b["estimatedDeparture"],
-                        platform=service_b["platform"]
-                    )
-
-                    calling_points_b = inject_origin_if_missing(
-                        origin_crs=transfer_crs,
-                        origin_name=service_b["origin"],
-                        scheduled_time=service_b["scheduledDeparture"],
-                        estimated_time=service_b["estimatedDeparture"],
-                        platform=service_b["platform"],
-                        calling_points=details_b.get("callingPoints", [])
-                    )
-
-                    crs_list_b = [cp["crs"] for cp in calling_points_b]
-                    if transfer_crs in crs_list_b and to_station in crs_list_b:
-                        if crs_list_b.index(transfer_crs) >= crs_list_b.index(to_station):
-                            continue
-                    else:
+                    schedule_b = raise_if_unavailable(fetcher.fetch_schedule(transfer_crs))
+                    if "departures" not in schedule_b:
                         continue
 
-                    arrival_cp_b = next(cp for cp in calling_points_b if cp["crs"] == to_station)
+                    for service_b in schedule_b["departures"]:
+                        departure_b_str = service_b.get("scheduledDeparture")
+                        if not departure_b_str:
+                            continue
 
-                    best_routes.append({
-                        "type": "indirect",
-                        "legs": [
-                            {
-                                "from": from_station,
-                                "to": transfer_crs,
-                                "departure": service["scheduledDeparture"],
-                                "arrival": arrival_time_str,
-                                "platform": service["platform"],
-                                "operator": service["operator"],
-                                "callingPoints": calling_points_a
-                            },
-                            {
-                                "from": transfer_crs,
-                                "to": to_station,
-                                "departure": service_b["scheduledDeparture"],
-                                "arrival": arrival_cp_b["scheduledTime"],
-                                "platform": service_b["platform"],
-                                "operator": service_b["operator"],
-                                "callingPoints": calling_points_b
-                            }
-                        ]
-                    })
+                        try:
+                            departure_minutes = time_to_minutes(departure_b_str)
+                            if departure_minutes < arrival_minutes + TRANSFER_BUFFER_MINUTES:
+                                continue
+                        except:
+                            continue
+
+                        details_b = raise_if_unavailable(fetcher.fetch_service_details(
+                            service_id=service_b["serviceID"],
+                            origin_name=service_b["origin"],
+                            scheduled_time=service_b["scheduledDeparture"],
+                            estimated_time=service_b["estimatedDeparture"],
+                            platform=service_b["platform"]
+                        ))
+
+                        calling_points_b = inject_origin_if_missing(
+                            origin_crs=transfer_crs,
+                            origin_name=service_b["origin"],
+                            scheduled_time=service_b["scheduledDeparture"],
+                            estimated_time=service_b["estimatedDeparture"],
+                            platform=service_b["platform"],
+                            calling_points=details_b.get("callingPoints", [])
+                        )
+
+                        crs_list_b = [cp["crs"] for cp in calling_points_b]
+                        if transfer_crs in crs_list_b and to_station in crs_list_b:
+                            if crs_list_b.index(transfer_crs) >= crs_list_b.index(to_station):
+                                continue
+                        else:
+                            continue
+
+                        arrival_cp_b = next(cp for cp in calling_points_b if cp["crs"] == to_station)
+
+                        best_routes.append({
+                            "type": "indirect",
+                            "legs": [
+                                {
+                                    "from": from_station,
+                                    "to": transfer_crs,
+                                    "departure": service["scheduledDeparture"],
+                                    "arrival": arrival_time_str,
+                                    "platform": service["platform"],
+                                    "operator": service["operator"],
+                                    "serviceID": service["serviceID"],
+                                    "callingPoints": calling_points_a
+                                },
+                                {
+                                    "from": transfer_crs,
+                                    "to": to_station,
+                                    "departure": service_b["scheduledDeparture"],
+                                    "arrival": arrival_cp_b["scheduledTime"],
+                                    "platform": service_b["platform"],
+                                    "operator": service_b["operator"],
+                                    "serviceID": service_b["serviceID"],
+                                    "callingPoints": calling_points_b
+                                }
+                            ]
+                        })
+
+        except HTTPException as e:
+            # A cold search can cost more calls than its budget allows. Rather than throw
+            # away what was found, the best route so far is returned marked partial: it
+            # may not be the optimal one, so it is never cached.
+            if e.status_code != 503 or not best_routes:
+                raise
+            partial = True
 
         # Returning earliest arriving route
         if best_routes:
             sorted_routes = sorted(best_routes, key=lambda r: time_to_minutes(r["legs"][-1]["arrival"]))
+            if partial:
+                return {**sorted_routes[0], "partial": True}
             return sorted_routes[0]
 
-        raise HTTPException(status_code=404, detail="No direct or indirect route found with valid direction and timing.")
+        raise HTTPException(status_code=404, detail=NO_ROUTE_DETAIL)
 
+    except HTTPException:
+        raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+route_cache = RouteCache(fetcher, find_optimal_route)
+
+@router.get("/optimal-route")
+def get_optimal_route(request: Request, from_station: str = Query(..., alias="from"), to_station: str = Query(..., alias="to")):
+    # Rejecting unknown stations before they are counted or looked up in the cache
+    from_crs = route_cache.normalize(from_station)
+    to_crs = route_cache.normalize(to_station)
+    for station, crs_code in ((from_station, from_crs), (to_station, to_crs)):
+        if not crs_code:
+            raise HTTPException(status_code=400, detail=f"Station '{station}' not found.")
+    from_station, to_station = from_crs, to_crs
+
+    hit, cached_route = route_cache.get(from_station, to_station)
+    if hit:
+        if cached_route is None:
+            raise HTTPException(status_code=404, detail=NO_ROUTE_DETAIL)
+        return cached_route
+
+    try:
+        with upstream_caller("optimal-route", user=caller_identity(request)):
+            route = find_optimal_route(from_station, to_station)
+    except HTTPException as e:
+        # Remembering pairs with no route briefly so popular dead ends don't rerun the search
+        if e.status_code == 404:
+            route_cache.put(from_station, to_station, None)
+        raise
+
+    # Partial routes aren't cached, so the next request searches again, starting
+    # from the boards and services this one already fetched
+    if not route.get("partial"):
+        route_cache.put(from_station, to_station, route)
+    return route
+
+@router.get("/optimal-route/stats")
+def get_route_cache_stats():
+    return route_cache.stats()
\ No newline at end of file
@@ -1,25 +1,155 @@
-from fastapi import APIRouter, Query
-from services.train_schedule_fetcher import TrainScheduleFetcher
+import asyncio
+from fastapi import APIRouter, Query, HTTPException, Request, WebSocket, WebSocketDisconnect
+from services.train_schedule_fetcher import fetcher
+from services.live_updates import LiveUpdateHub, SUBSCRIBER_QUEUE_SIZE
+from services.upstream_governor import upstream_caller
+from utils.upstream import raise_if_unavailable, caller_identity
 
 router = APIRouter()
-fetcher = TrainScheduleFetcher()
+live_hub = LiveUpdateHub(fetcher)
+
+MAX_BOARD_STATIONS = 20
+
+# Limits on what one WebSocket client can make the server poll
+MAX_SUBSCRIPTIONS_PER_SOCKET = 20
+MAX_SERVICE_ID_LENGTH = 64
+
+@router.get("/upstream/usage")
+def get_upstream_usage():
+    return fetcher.governor.usage()
+
+# Declared before /trains/{station_code} so "boards" isn't treated as a station code
+@router.get("/trains/boards")
+def get_train_boards(
+    request: Request,
+    crs: str = Query(..., description="Comma-separated CRS codes or station names"),
+    numRows: int = Query(10, ge=1, le=150),
+    timeOffset: int = Query(None, ge=-120, le=120),
+    timeWindow: int = Query(None, ge=-120, le=120)
+):
+    stations = [s.strip() for s in crs.split(",") if s.strip()]
+    if not stations:
+        raise HTTPException(status_code=400, detail="No stations given.")
+    if len(stations) > MAX_BOARD_STATIONS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BOARD_STATIONS} stations per request.")
+
+    with upstream_caller("trains", user=caller_identity(request)):
+        return fetcher.fetch_boards(
+            stations,
+            num_rows=numRows,
+            time_offset=timeOffset,
+            time_window=timeWindow
+        )
 
 @router.get("/trains/{station_code}")
-def get_train_info(station_code: str):
-    return fetcher.fetch_schedule(station_code)
+def get_train_info(
+    request: Request,
+    station_code: str,
+    numRows: int = Query(10, ge=1, le=150),
+    timeOffset: int = Query(None, ge=-120, le=120),
+    timeWindow: int = Query(None, ge=-120, le=120)
+):
+    with upstream_caller("trains", user=caller_identity(request)):
+        return raise_if_unavailable(fetcher.fetch_schedule(
+            station_code,
+            num_rows=numRows,
+            time_offset=timeOffset,
+            time_window=timeWindow
+        ))
 
 @router.get("/trains/details/{service_id}")
 def get_train_details(
+    request: Request,
     service_id: str,
     originName: str = Query(None),
     scheduledTime: str = Query(None),
     estimatedTime: str = Query(None),
     platform: str = Query(None)
 ):
-    return fetcher.fetch_service_details(
-        service_id,
-        origin_name=originName,
-        scheduled_time=scheduledTime,
-        estimated_time=estimatedTime,
-        platform=platform
-    )
\ No newline at end of file
+    with upstream_caller("trains", user=caller_identity(request)):
+        return raise_if_unavailable(fetcher.fetch_service_details(
+            service_id,
+            origin_name=originName,
+            scheduled_time=scheduledTime,
+            estimated_time=estimatedTime,
+            platform=platform
+        ))
+
+async def forward_updates(websocket: WebSocket, queue: asyncio.Queue):
+    while True:
+        message = await queue.get()
+        await websocket.send_json(message)
+
+def send_error(queue: asyncio.Queue, detail: str):
+    try:
+        queue.put_nowait({"type": "error", "detail": detail})
+    except asyncio.QueueFull:
+        pass
+
+@router.websocket("/trains/live")
+async def live_updates(websocket: WebSocket):
+    """
+    Watch services and stations over a single socket.
+    Clients send {"action": "subscribe" | "unsubscribe", "service": id} or
+    {"action": ..., "station": crs}; they receive a snapshot followed by diffs.
+    """
+    await websocket.accept()
+    queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+    sender = asyncio.create_task(forward_updates(websocket, queue))
+
+    try:
+        while True:
+            try:
+                message = await websocket.receive_json()
+            except (ValueError, KeyError):
+                # Invalid JSON raises ValueError; binary frames have no text and raise KeyError
+                send_error(queue, "Messages must be JSON text.")
+                continue
+
+            if not isinstance(message, dict):
+                send_error(queue, "Messages must be JSON objects.")
+                continue
+
+            action = message.get("action")
+            if action not in ("subscribe", "unsubscribe"):
+                send_error(queue, f"Unknown action '{action}'.")
+                continue
+
+            if message.get("service"):
+                service_id = str(message["service"])
+                if len(service_id) > MAX_SERVICE_ID_LENGTH:
+                    send_error(queue, "Invalid service ID.")
+                    continue
+                key = ("service", service_id)
+            elif message.get("station"):
+                crs_code = fetcher.resolve_crs(str(message["station"]))
+                if not crs_code:
+                    send_error(queue, f"Station '{message['station']}' not found.")
+                    continue
+                key = ("station", crs_code)
+            else:
+                send_error(queue, "Expected a 'service' or 'station' to watch.")
+                continue
+
+            # Topics the hub stopped (e.g. unknown services) no longer count towards the cap
+            subscriptions = set(live_hub.subscriptions_for(queue))
+
+            if action == "subscribe" and key not in subscriptions:
+                if len(subscriptions) >= MAX_SUBSCRIPTIONS_PER_SOCKET:
+                    send_error(queue, f"At most {MAX_SUBSCRIPTIONS_PER_SOCKET} subscriptions per connection.")
+                    continue
+                if key[0] == "service":
+                    live_hub.subscribe_service(key[1], queue)
+                else:
+                    live_hub.subscribe_station(key[1], queue)
+                subscriptions.add(key)
+            elif action == "unsubscribe" and key in subscriptions:
+                live_hub.unsubscribe(key, queue)
+                subscriptions.discard(key)
+
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
+        for key in live_hub.subscriptions_for(queue):
+            live_hub.unsubscribe(key, queue)
@@ -0,0 +1,179 @@
+import os
+import asyncio
+from fastapi.encoders import jsonable_encoder
+from services.upstream_governor import call_as
+
+# How often each watched service or station is re-fetched from Darwin
+LIVE_POLL_INTERVAL_SECONDS = int(os.getenv("LIVE_POLL_INTERVAL_SECONDS", "30"))
+
+# Messages buffered per client; a client that falls behind is resynced with a snapshot
+SUBSCRIBER_QUEUE_SIZE = 100
+
+# Polls in a row that may fail before a topic is stopped and its subscribers told
+MAX_CONSECUTIVE_ERRORS = 5
+
+# Fields compared between polls to decide what changed
+CALLING_POINT_FIELDS = ["estimatedTime", "actualTime", "platform", "isCancelled"]
+DEPARTURE_FIELDS = ["estimatedDeparture", "platform", "isCancelled", "delayReason", "cancelReason"]
+
+
+def diff_calling_points(old, new):
+    """
+    Compare two service details payloads and return only the calling points that changed.
+    """
+    old_points = {(cp["crs"], cp["scheduledTime"]): cp for cp in old.get("callingPoints", [])}
+    changes = []
+    for cp in new.get("callingPoints", []):
+        previous = old_points.get((cp["crs"], cp["scheduledTime"]))
+        if previous is None or any(previous.get(f) != cp.get(f) for f in CALLING_POINT_FIELDS):
+            changes.append(cp)
+    return {"changed": changes}
+
+
+def diff_departures(old, new):
+    """
+    Compare two departure boards and return added, changed and removed services.
+    """
+    old_services = {s["serviceID"]: s for s in old.get("departures", [])}
+    new_services = {s["serviceID"]: s for s in new.get("departures", [])}
+
+    added = [s for sid, s in new_services.items() if sid not in old_services]
+    changed = [
+        s for sid, s in new_services.items()
+        if sid in old_services and any(old_services[sid].get(f) != s.get(f) for f in DEPARTURE_FIELDS)
+    ]
+    removed = [sid for sid in old_services if sid not in new_services]
+    return {"added": added, "changed": changed, "removed": removed}
+
+
+class Topic:
+    """
+    A single watched service or station with its subscribers and shared poller.
+    """
+    def __init__(self, fetch, diff):
+        self.fetch = fetch
+        self.diff = diff
+        self.subscribers = set()
+        self.latest = None
+        self.task = None
+        self.errors = 0
+
+        # Subscribers that missed an update and need a fresh snapshot before more diffs
+        self.out_of_sync = set()
+
+
+class LiveUpdateHub:
+    """
+    Runs one Darwin poller per watched service or station, however many clients
+    are subscribed, and pushes only the differences between polls to subscribers.
+    """
+    def __init__(self, fetcher, poll_interval=LIVE_POLL_INTERVAL_SECONDS):
+        self.fetcher = fetcher
+        self.poll_interval = poll_interval
+        self.topics = {}
+
+    def subscribe_service(self, service_id: str, queue):
+        key = ("service", service_id)
+        return self._subscribe(
+            key, queue,
+            lambda: self.fetcher.fetch_service_details(service_id, fresh=True),
+            diff_calling_points
+        )
+
+    def subscribe_station(self, crs_code: str, queue):
+        key = ("station", crs_code)
+        return self._subscribe(
+            key, queue,
+            lambda: self.fetcher.fetch_schedule(crs_code, fresh=True),
+            diff_departures
+        )
+
+    def subscriptions_for(self, queue):
+        return [key for key, topic in self.topics.items() if queue in topic.subscribers]
+
+    def unsubscribe(self, key, queue):
+        topic = self.topics.get(key)
+        if not topic:
+            return
+        topic.subscribers.discard(queue)
+        topic.out_of_sync.discard(queue)
+
+        # Stopping the poller once nobody is watching
+        if not topic.subscribers:
+            topic.task.cancel()
+            del self.topics[key]
+
+    def _subscribe(self, key, queue, fetch, diff):
+        topic = self.topics.get(key)
+        if topic is None:
+            topic = Topic(fetch, diff)
+            self.topics[key] = topic
+            topic.task = asyncio.create_task(self._poll(key, topic))
+        elif topic.latest is not None:
+            # Late joiners get the current state straight away
+            if not self._send(queue, self._snapshot(key, topic)):
+                topic.out_of_sync.add(queue)
+
+        topic.subscribers.add(queue)
+        return key
+
+    async def _poll(self, key, topic):
+        while True:
+            try:
+                data = await asyncio.to_thread(call_as, "live", topic.fetch)
+            except Exception as e:
+                data = {"error": str(e)}
+
+            if "error" in data:
+                topic.errors += 1
+
+                # Unknown services and persistently failing topics stop polling Darwin
+                if topic.latest is None or topic.errors >= MAX_CONSECUTIVE_ERRORS:
+                    self._broadcast(topic, {"type": "error", "topic": list(key), "detail": data["error"], "unsubscribed": True})
+                    self._stop(key, topic)
+                    return
+                self._broadcast(topic, {"type": "error", "topic": list(key), "detail": data["error"]})
+            elif topic.latest is None:
+                topic.errors = 0
+                topic.latest = data
+                self._broadcast(topic, self._snapshot(key, topic))
+            else:
+                topic.errors = 0
+                changes = topic.diff(topic.latest, data)
+                topic.latest = data
+                if any(changes.values()):
+                    self._broadcast(topic, {"type": "update", "topic": list(key), **changes})
+
+            self._resync(key, topic)
+            await asyncio.sleep(self.poll_interval)
+
+    def _stop(self, key, topic):
+        if self.topics.get(key) is topic:
+            del self.topics[key]
+        topic.subscribers.clear()
+        topic.out_of_sync.clear()
+
+    def _snapshot(self, key, topic):
+        return {"type": "snapshot", "topic": list(key), "data": topic.latest}
+
+    def _resync(self, key, topic):
+        # Replacing missed diffs with the current state once there is room in the queue
+        if topic.latest is None:
+            return
+        for queue in list(topic.out_of_sync):
+            if self._send(queue, self._snapshot(key, topic)):
+                topic.out_of_sync.discard(queue)
+
+    def _broadcast(self, topic, message):
+        for queue in list(topic.subscribers):
+            if queue in topic.out_of_sync:
+                continue
+            if not self._send(queue, message):
+                topic.out_of_sync.add(queue)
+
+    def _send(self, queue, message):
+        try:
+            queue.put_nowait(jsonable_encoder(message))
+            return True
+        except asyncio.QueueFull:
+            return False
@@ -0,0 +1,203 @@
+import os
+import time
+import threading
+from collections import Counter
+from services.upstream_governor import upstream_caller
+
+# Width of the departure-time buckets routes are cached under
+ROUTE_BUCKET_MINUTES = int(os.getenv("ROUTE_BUCKET_MINUTES", "15"))
+
+# Longest a cached route is served, even if none of its boards or services changed
+ROUTE_CACHE_TTL_SECONDS = int(os.getenv("ROUTE_CACHE_TTL_SECONDS", "120"))
+
+# Longest a "no route found" answer is served
+ROUTE_NEGATIVE_TTL_SECONDS = int(os.getenv("ROUTE_NEGATIVE_TTL_SECONDS", "30"))
+
+# How often the most requested pairs are checked in the background. Keeping this well
+# under the TTL means unchanged routes survive several passes before being recomputed.
+ROUTE_PRECOMPUTE_INTERVAL_SECONDS = int(os.getenv("ROUTE_PRECOMPUTE_INTERVAL_SECONDS", "30"))
+
+# Number of most requested origin-destination pairs kept warm
+ROUTE_PRECOMPUTE_TOP_PAIRS = int(os.getenv("ROUTE_PRECOMPUTE_TOP_PAIRS", "100"))
+
+
+class RouteCache:
+    """
+    Caches optimal routes, and pairs with no route, per (from, to, departure-time bucket).
+    Each entry remembers the versions of the boards and services it was built from
+    and is dropped as soon as any of them changes in the fetcher's cache.
+
+    Those versions are local to the process, so every worker process keeps and
+    precomputes its own most requested pairs. Precomputation is charged to the
+    route-precompute budget, which UPSTREAM_BUDGET_DB shares between workers, so
+    more workers don't mean more Darwin calls.
+    """
+    def __init__(self, fetcher, compute_route):
+        self.fetcher = fetcher
+        self.compute_route = compute_route
+
+        # (from, to, bucket) -> (cached_at, route or None, dependencies, ttl)
+        self.entries = {}
+
+        # Request counts per (from, to), halved every precompute pass so old traffic fades
+        self.pair_counts = Counter()
+
+        self.lock = threading.Lock()
+        self.precompute_thread = None
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.precomputed = 0
+
+    def normalize(self, station: str):
+        """
+        Map a CRS code or station name to its CRS code, so every spelling shares one entry.
+        Returns None for unknown stations, which must not be looked up or counted.
+        """
+        return self.fetcher.resolve_crs(station)
+
+    def get(self, from_station: str, to_station: str):
+        """
+        Look up a pair of normalized stations.
+        Returns (hit, route); on a hit, a route of None means no route was found.
+        """
+        self._ensure_precompute()
+        key = self._key(from_station, to_station)
+
+        with self.lock:
+            self.pair_counts[(from_station, to_station)] += 1
+            entry = self.entries.get(key)
+
+        if entry and self._is_valid(entry):
+            with self.lock:
+                self.hits += 1
+            return True, entry[1]
+
+        with self.lock:
+            if entry:
+                self.invalidations += 1
+                self.entries.pop(key, None)
+            self.misses += 1
+        return False, None
+
+    def put(self, from_station: str, to_station: str, route):
+        """
+        Cache a freshly computed route, or None for no route, with the versions of its inputs.
+        """
+        if route is None:
+            # A new departure at the origin may produce a route, so that board is the input
+            dependencies = [self._board_dependency(from_station)]
+            ttl = ROUTE_NEGATIVE_TTL_SECONDS
+        else:
+            dependencies = self._dependencies(route)
+            ttl = ROUTE_CACHE_TTL_SECONDS
+
+        with self.lock:
+            self.entries[self._key(from_station, to_station)] = (time.monotonic(), route, dependencies, ttl)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "precomputed": self.precomputed,
+                "cachedRoutes": len(self.entries),
+                "trackedPairs": len(self.pair_counts)
+            }
+
+    def _key(self, from_station, to_station):
+        bucket = int(time.time() // (ROUTE_BUCKET_MINUTES * 60))
+        return (from_station, to_station, bucket)
+
+    def _board_dependency(self, station):
+        crs_code = self.normalize(station) or station
+        return ("board", crs_code, self.fetcher.board_version(crs_code))
+
+    def _dependencies(self, route):
+        """
+        Record the boards each leg departs from and the services each leg rides.
+        """
+        dependencies = []
+        for leg in route.get("legs", []):
+            dependencies.append(self._board_dependency(leg["from"]))
+            if leg.get("serviceID"):
+                dependencies.append(("service", leg["serviceID"], self.fetcher.details_version(leg["serviceID"])))
+        return dependencies
+
+    def _is_valid(self, entry):
+        cached_at, _, dependencies, ttl = entry
+        if time.monotonic() - cached_at >= ttl:
+            return False
+
+        for kind, key, version in dependencies:
+            if kind == "board":
+                current = self.fetcher.board_version(key)
+            else:
+                current = self.fetcher.details_version(key)
+            if current != version:
+                return False
+        return True
+
+    def _expires_within(self, entry, seconds):
+        cached_at, _, _, ttl = entry
+        return time.monotonic() - cached_at + seconds >= ttl
+
+    def _ensure_precompute(self):
+        # Started lazily so the thread belongs to the process actually serving requests
+        with self.lock:
+            if self.precompute_thread and self.precompute_thread.is_alive():
+                return
+            self.precompute_thread = threading.Thread(target=self._precompute_loop, daemon=True)
+            self.precompute_thread.start()
+
+    def _precompute_loop(self):
+        while True:
+            time.sleep(ROUTE_PRECOMPUTE_INTERVAL_SECONDS)
+
+            with self.lock:
+                top_pairs = [pair for pair, _ in self.pair_counts.most_common(ROUTE_PRECOMPUTE_TOP_PAIRS)]
+                self.pair_counts = Counter({
+                    pair: count // 2
+                    for pair, count in self.pair_counts.most_common(ROUTE_PRECOMPUTE_TOP_PAIRS * 5)
+                    if count // 2
+                })
+
+                # Dropping routes that have outlived their TTL
+                for key in [k for k, entry in self.entries.items() if self._expires_within(entry, 0)]:
+                    del self.entries[key]
+
+            self._precompute(top_pairs)
+
+    def _precompute(self, pairs):
+        for from_station, to_station in pairs:
+            with self.lock:
+                entry = self.entries.get(self._key(from_station, to_station))
+
+            # Skipping entries whose inputs are unchanged and that outlive the next pass
+            if entry and self._is_valid(entry) and not self._expires_within(entry, ROUTE_PRECOMPUTE_INTERVAL_SECONDS):
+                continue
+
+            try:
+                with upstream_caller("route-precompute"):
+                    route = self.compute_route(from_station, to_station)
+            except Exception as e:
+                status_code = getattr(e, "status_code", None)
+                if status_code == 404:
+                    route = None
+                elif status_code == 503:
+                    # Out of upstream budget; trying more pairs would only be rejected too
+                    return
+                else:
+                    continue
+
+            if route is not None and route.get("partial"):
+                # Ran out of upstream budget part way through this search
+                return
+
+            self.put(from_station, to_station, route)
+            with self.lock:
+                self.precomputed += 1
@@ -1,17 +1,79 @@
 import os
 import csv
+import time
+import threading
+import itertools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from requests.exceptions import RequestException
 from zeep import Client, xsd
+from zeep.transports import Transport
+from services.upstream_governor import UpstreamGovernor, caller_limits
 from datetime import datetime
 
 load_dotenv()
 
+class UpstreamUnavailable(Exception):
+    """
+    Raised when Darwin is overloaded, timed out or unreachable.
+    """
+    pass
+
+class Flight:
+    """
+    A loader call in progress that other callers for the same cache key wait on.
+    """
+    def __init__(self, priority):
+        self.done = threading.Event()
+        self.result = None
+
+        # Priority of the caller running the loader, and whether it is waiting for budget
+        self.priority = priority
+        self.queued = threading.Event()
+
+# The flight being run on this thread, so its Darwin call can report queueing for budget
+current_flight = contextvars.ContextVar("current_flight", default=None)
+
+# How long a fetched departure board is reused before asking Darwin again
+BOARD_CACHE_TTL_SECONDS = int(os.getenv("BOARD_CACHE_TTL_SECONDS", "30"))
+
+# How long fetched service details are reused before asking Darwin again
+DETAILS_CACHE_TTL_SECONDS = int(os.getenv("DETAILS_CACHE_TTL_SECONDS", "30"))
+
+# Oldest board or service details still served (marked stale) while Darwin is slow or failing
+STALE_MAX_AGE_SECONDS = int(os.getenv("STALE_MAX_AGE_SECONDS", "600"))
+
+# Cache size at which entries too old to serve even as stale are dropped
+CACHE_PRUNE_THRESHOLD = 5000
+
+# Deadline for a single Darwin SOAP call
+UPSTREAM_TIMEOUT_SECONDS = float(os.getenv("UPSTREAM_TIMEOUT_SECONDS", "5"))
+
+# Darwin calls allowed in flight at once; anything beyond this is shed immediately
+MAX_UPSTREAM_CONCURRENCY = int(os.getenv("MAX_UPSTREAM_CONCURRENCY", "16"))
+
+# Retry-After hint sent with 503s when Darwin is unavailable
+UPSTREAM_RETRY_AFTER_SECONDS = 5
+
+# How often a caller waiting on another caller's fetch checks whether to stop waiting
+FLIGHT_POLL_SECONDS = 0.05
+
+# Upper bound on concurrent GetDepartureBoard calls for multi-station requests
+MAX_BOARD_WORKERS = int(os.getenv("MAX_BOARD_WORKERS", "8"))
+
+# Threads refreshing stale entries in the background
+MAX_REFRESH_WORKERS = int(os.getenv("MAX_REFRESH_WORKERS", "4"))
+
 class TrainScheduleFetcher:
     def __init__(self, csv_file='stations.csv'):
         self.api_key = os.getenv("NRE_API_KEY")
         self.wsdl_url = "https://lite.realtime.nationalrail.co.uk/OpenLDBWS/wsdl.aspx"
-        self.client = Client(wsdl=self.wsdl_url)
-        
+        self.client = Client(
+            wsdl=self.wsdl_url,
+            transport=Transport(operation_timeout=UPSTREAM_TIMEOUT_SECONDS)
+        )
+
         # Loading CSV mapping CRS codes to station names
         self.station_map = self.load_station_map(csv_file)
 
@@ -22,6 +84,37 @@ class TrainScheduleFetcher:
         header_type = xsd.ComplexType([xsd.Element('TokenValue', xsd.String())])
         self.access_token = xsd.Element('AccessToken', header_type)(TokenValue=self.api_key)
 
+        # Last good boards: (crs, numRows, timeOffset, timeWindow) -> (fetched_at, board, version)
+        self.board_cache = {}
+
+        # Last good service details: serviceID -> (fetched_at, details, version)
+        self.details_cache = {}
+
+        # Versions only change when fetched content changes, so dependants can detect updates
+        self.versions = itertools.count(1)
+
+        # Fetches in progress per cache key, so concurrent misses ask Darwin once
+        self.in_flight = {}
+        self.cache_lock = threading.Lock()
+
+        # Limiting concurrent Darwin calls so a slow upstream can't pile up threads
+        self.upstream_slots = threading.BoundedSemaphore(MAX_UPSTREAM_CONCURRENCY)
+
+        # Rationing the NRE token's quota between endpoints and users
+        self.governor = UpstreamGovernor()
+
+        # Shared pool for fetching several boards at once
+        self.executor = ThreadPoolExecutor(max_workers=MAX_BOARD_WORKERS)
+
+        # Separate pool for background refreshes so they never hold up /trains/boards
+        self.refresh_executor = ThreadPoolExecutor(max_workers=MAX_REFRESH_WORKERS)
+
+    def reset_after_fork(self):
+        """
+        Drop HTTP connections inherited from the parent process so each worker opens its own.
+        """
+        self.client.transport.session.close()
+
     def load_station_map(self, csv_file):
         """
         Load the CRS to station name mapping from a CSV file.
@@ -50,26 +143,229 @@ class TrainScheduleFetcher:
         """
         return self.station_map.get(station_code, station_code)  # Returning CRS code if not found
 
-    def fetch_schedule(self, station_input: str):
+    def resolve_crs(self, station_input: str):
         """
-        Fetch schedule data for the given station input (can be CRS or station name).
+        Resolve a station input (CRS code or station name) to a CRS code, or None if unknown.
         """
-        # Determining if the input is a CRS code or a station name
         if len(station_input) == 3 and station_input.upper() in self.station_map:
-            crs_code = station_input.upper()
-        else:
-            crs_code = self.get_crs_from_station_name(station_input)
+            return station_input.upper()
+        return self.get_crs_from_station_name(station_input)
+
+    def fetch_schedule(self, station_input: str, num_rows=10, time_offset=None, time_window=None, fresh=False):
+        """
+        Fetch schedule data for the given station input (can be CRS or station name).
+        Boards are cached for BOARD_CACHE_TTL_SECONDS per CRS code and query window;
+        fresh=True always asks Darwin, using the cache only if that fails.
+        """
+        crs_code = self.resolve_crs(station_input)
+        if not crs_code:
+            return {"error": f"Station '{station_input}' not found."}
+
+        return self.fetch_cached(
+            self.board_cache,
+            (crs_code, num_rows, time_offset, time_window),
+            BOARD_CACHE_TTL_SECONDS,
+            lambda: self._fetch_board(crs_code, num_rows, time_offset, time_window),
+            fresh
+        )
+
+    def fetch_boards(self, station_inputs, num_rows=10, time_offset=None, time_window=None):
+        """
+        Fetch departure boards for several stations concurrently.
+        Duplicate stations are fetched once; unknown stations and upstream failures
+        are reported per station instead of failing the whole request.
+        """
+        boards = {}
+        errors = {}
+        pending = {}
+
+        for station_input in station_inputs:
+            crs_code = self.resolve_crs(station_input)
             if not crs_code:
-                return {"error": f"Station '{station_input}' not found."}
+                errors[station_input] = f"Station '{station_input}' not found."
+            elif crs_code not in pending:
+                # Carrying the caller's context so pooled calls are charged to the same endpoint and user
+                pending[crs_code] = self.executor.submit(
+                    contextvars.copy_context().run,
+                    self.fetch_schedule, crs_code, num_rows, time_offset, time_window
+                )
+
+        for crs_code, future in pending.items():
+            try:
+                board = future.result()
+            except Exception as e:
+                board = {"error": str(e)}
+
+            if "error" in board:
+                errors[crs_code] = board["error"]
+            else:
+                boards[crs_code] = board
+
+        return {"boards": boards, "errors": errors}
+
+    def fetch_cached(self, cache, key, ttl, loader, fresh=False):
+        """
+        Serve a cached result using stale-while-revalidate.
+        Fresh entries are returned as-is. Entries older than ttl are returned with
+        a stale marker while a background refresh runs. Without a usable entry, or
+        when fresh is set, the loader runs inline, falling back to the last good
+        result if it fails. Concurrent callers for the same key share one loader call.
+        """
+        with self.cache_lock:
+            cached = cache.get(key)
+
+        age = time.monotonic() - cached[0] if cached else None
+        if cached and age < ttl and not fresh:
+            return cached[1]
+
+        if cached and age < STALE_MAX_AGE_SECONDS and not fresh:
+            self._refresh_in_background(cache, key, loader)
+            return {**cached[1], "stale": True, "ageSeconds": int(age)}
+
+        flight, leader = self._join_flight(cache, key)
+        if leader:
+            result = self._fly(cache, key, loader, flight)
+        else:
+            result = self._follow(cache, key, loader, flight)
+
+        if "error" not in result:
+            return result
+
+        if cached and age < STALE_MAX_AGE_SECONDS:
+            return {**cached[1], "stale": True, "ageSeconds": int(age)}
+        return result
+
+    def board_version(self, crs_code: str, num_rows=10, time_offset=None, time_window=None):
+        """
+        Return the version of the cached board for a CRS code, or None if it isn't cached.
+        """
+        return self._version(self.board_cache, (crs_code, num_rows, time_offset, time_window))
+
+    def details_version(self, service_id: str):
+        """
+        Return the version of the cached details for a service, or None if they aren't cached.
+        """
+        return self._version(self.details_cache, service_id)
 
+    def _version(self, cache, key):
+        with self.cache_lock:
+            cached = cache.get(key)
+        return cached[2] if cached else None
+
+    def _store(self, cache, key, result):
+        """
+        Record a good result, pruning entries too old to serve once the cache grows large.
+        The version is bumped only when the content differs from the previous result.
+        """
+        now = time.monotonic()
+        content = {k: v for k, v in result.items() if k != "generatedAt"}
+        with self.cache_lock:
+            previous = cache.get(key)
+            if previous and {k: v for k, v in previous[1].items() if k != "generatedAt"} == content:
+                version = previous[2]
+            else:
+                version = next(self.versions)
+            cache[key] = (now, result, version)
+
+            if len(cache) > CACHE_PRUNE_THRESHOLD:
+                for old_key in [k for k, entry in cache.items() if now - entry[0] >= STALE_MAX_AGE_SECONDS]:
+                    del cache[old_key]
+
+    def _refresh_in_background(self, cache, key, loader):
+        """
+        Re-run loader for a stale cache entry, unless a fetch for it is already in progress.
+        """
+        flight, leader = self._join_flight(cache, key)
+        if leader:
+            self.refresh_executor.submit(contextvars.copy_context().run, self._fly, cache, key, loader, flight)
+
+    def _join_flight(self, cache, key):
+        """
+        Return the in-progress fetch for a key and whether the caller must run it.
+        """
+        with self.cache_lock:
+            flight = self.in_flight.get((id(cache), key))
+            if flight:
+                return flight, False
+            flight = Flight(caller_limits()[0])
+            self.in_flight[(id(cache), key)] = flight
+            return flight, True
+
+    def _fly(self, cache, key, loader, flight):
+        token = current_flight.set(flight)
+        try:
+            flight.result = self._load(cache, key, loader)
+        finally:
+            current_flight.reset(token)
+            with self.cache_lock:
+                self.in_flight.pop((id(cache), key), None)
+            flight.done.set()
+        return flight.result
+
+    def _follow(self, cache, key, loader, flight):
+        """
+        Wait for another caller's fetch of the same key, no longer than this caller
+        would wait for budget and Darwin itself. A more urgent caller doesn't wait
+        behind a fetch that is only queued for budget, and makes its own call instead.
+        """
+        priority, deadline = caller_limits()
+        timed_out = {"error": "National Rail did not respond in time.", "unavailable": True}
+
+        while not flight.done.wait(FLIGHT_POLL_SECONDS):
+            if flight.queued.is_set():
+                if priority < flight.priority:
+                    return self._load(cache, key, loader)
+                if time.time() > deadline:
+                    return timed_out
+            elif time.time() > deadline + UPSTREAM_TIMEOUT_SECONDS:
+                return timed_out
+        return flight.result
+
+    def _load(self, cache, key, loader):
+        try:
+            result = loader()
+        except Exception as e:
+            return {"error": str(e)}
+        if "error" not in result:
+            self._store(cache, key, result)
+        return result
+
+    def call_upstream(self, operation: str, **kwargs):
+        """
+        Call a Darwin SOAP operation once the caller's budget allows it, shedding load
+        when too many calls are already in flight.
+        """
+        flight = current_flight.get()
+        grant = self.governor.acquire(operation, queued=flight.queued if flight else None)
+        if grant is None:
+            raise UpstreamUnavailable("National Rail request budget exhausted, please try again shortly.")
+        if not self.upstream_slots.acquire(blocking=False):
+            # Shed before reaching Darwin, so the quota wasn't spent
+            self.governor.refund(grant)
+            raise UpstreamUnavailable("National Rail is busy, please try again shortly.")
+
+        self.governor.spent(grant)
+        try:
+            return getattr(self.client.service, operation)(_soapheaders=[self.access_token], **kwargs)
+        except RequestException as e:
+            raise UpstreamUnavailable(f"National Rail did not respond: {e}")
+        finally:
+            self.upstream_slots.release()
+
+    def _fetch_board(self, crs_code: str, num_rows=10, time_offset=None, time_window=None):
+        """
+        Call GetDepartureBoard for a resolved CRS code and parse the departures.
+        """
         # Fetching station name
         station_name = self.fetch_station_name(crs_code)
 
         try:
-            raw_response = self.client.service.GetDepartureBoard(
-                numRows=10,
+            raw_response = self.call_upstream(
+                "GetDepartureBoard",
+                numRows=num_rows,
                 crs=crs_code,
-                _soapheaders=[self.access_token]
+                timeOffset=time_offset,
+                timeWindow=time_window
             )
 
             services = []
@@ -123,18 +419,79 @@ class TrainScheduleFetcher:
                 "departures": services
             }
 
+        except UpstreamUnavailable as e:
+            return {"error": str(e), "unavailable": True}
         except Exception as e:
             return {"error": str(e)}
 
-    def fetch_service_details(self, service_id: str, origin_name=None, scheduled_time=None, estimated_time=None, platform=None):
+    def fetch_service_details(self, service_id: str, origin_name=None, scheduled_time=None, estimated_time=None, platform=None, fresh=False):
         """
         Fetch detailed service information, including calling points.
+        Details are cached for DETAILS_CACHE_TTL_SECONDS per service;
+        fresh=True always asks Darwin, using the cache only if that fails.
         """
+        details = self.fetch_cached(
+            self.details_cache,
+            service_id,
+            DETAILS_CACHE_TTL_SECONDS,
+            lambda: self._fetch_details(service_id),
+            fresh
+        )
+        if "error" in details:
+            return details
+
         try:
-            raw_details = self.client.service.GetServiceDetails(
-                serviceID=service_id,
-                _soapheaders=[self.access_token]
-            )
+            # Copying so callers and origin injection never modify the cached entry
+            calling_points = [dict(cp) for cp in details["callingPoints"]]
+
+            # Injecting origin station if not in list
+            if origin_name and calling_points:
+                found = any(cp["locationName"] == origin_name for cp in calling_points)
+                if not found:
+                    injected_cp = {
+                        "locationName": origin_name,
+                        "crs": "UNK",
+                        "scheduledTime": scheduled_time or "Unknown",
+                        "estimatedTime": estimated_time or "—",
+                        "actualTime": None,
+                        "platform": platform or "N/A",
+                        "isCancelled": False
+                    }
+                    # Inserting based on time
+                    insert_index = 0
+                    for i, cp in enumerate(calling_points):
+                        if (scheduled_time and cp['scheduledTime'] != "Unknown" and 
+                                datetime.strptime(scheduled_time, '%H:%M').time() < datetime.strptime(cp['scheduledTime'], '%H:%M').time()):
+                            insert_index = i
+                            break
+                    calling_points.insert(insert_index, injected_cp)
+
+            # Sorting calling points by scheduled time
+            calling_points.sort(key=lambda x: x['scheduledTime'] if x['scheduledTime'] != "Unknown" else datetime.max.time())
+
+            origin = calling_points[0]["locationName"] if calling_points else "Unknown"
+            destination = calling_points[-1]["locationName"] if calling_points else "Unknown"
+
+            result = {
+                "generatedAt": details["generatedAt"],
+                "origin": origin,
+                "destination": destination,
+                "callingPoints": calling_points
+            }
+            if details.get("stale"):
+                result["stale"] = True
+                result["ageSeconds"] = details["ageSeconds"]
+            return result
+
+        except Exception as e:
+            return {"error": str(e)}
+
+    def _fetch_details(self, service_id: str):
+        """
+        Call GetServiceDetails and flatten the previous and subsequent calling points.
+        """
+        try:
+            raw_details = self.call_upstream("GetServiceDetails", serviceID=service_id)
 
             calling_points = []
 
@@ -166,42 +523,19 @@ class TrainScheduleFetcher:
                             "scheduledTime": cp.get("st", "Unknown"),
                             "estimatedTime": cp.get("et", "Unknown"),
                             "actualTime": cp.get("at", None),
-                            "platform": cp.get("platform", "N/A")
+                            "platform": cp.get("platform", "N/A"),
+                            "isCancelled": cp.get("isCancelled", False)
                         })
 
-            # Injecting origin station if not in list
-            if origin_name and calling_points:
-                found = any(cp["locationName"] == origin_name for cp in calling_points)
-                if not found:
-                    injected_cp = {
-                        "locationName": origin_name,
-                        "crs": "UNK",
-                        "scheduledTime": scheduled_time or "Unknown",
-                        "estimatedTime": estimated_time or "—",
-                        "actualTime": None,
-                        "platform": platform or "N/A"
-                    }
-                    # Inserting based on time
-                    insert_index = 0
-                    for i, cp in enumerate(calling_points):
-                        if (scheduled_time and cp['scheduledTime'] != "Unknown" and 
-                                datetime.strptime(scheduled_time, '%H:%M').time() < datetime.strptime(cp['scheduledTime'], '%H:%M').time()):
-                            insert_index = i
-                            break
-                    calling_points.insert(insert_index, injected_cp)
-
-            # Sorting calling points by scheduled time
-            calling_points.sort(key=lambda x: x['scheduledTime'] if x['scheduledTime'] != "Unknown" else datetime.max.time())
-
-            origin = calling_points[0]["locationName"] if calling_points else "Unknown"
-            destination = calling_points[-1]["locationName"] if calling_points else "Unknown"
-
             return {
                 "generatedAt": getattr(raw_details, "generatedAt", "Unknown"),
-                "origin": origin,
-                "destination": destination,
                 "callingPoints": calling_points
             }
 
+        except UpstreamUnavailable as e:
+            return {"error": str(e), "unavailable": True}
         except Exception as e:
-            return {"error": str(e)}
\ No newline at end of file
+            return {"error": str(e)}
+
+# Shared by all routers so the WSDL and station data are loaded once per process
+fetcher = TrainScheduleFetcher()
@@ -0,0 +1,322 @@
+import os
+import time
+import sqlite3
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Overall Darwin budget shared by every endpoint (token refill per second, bucket size)
+UPSTREAM_RATE_PER_SECOND = float(os.getenv("UPSTREAM_RATE_PER_SECOND", "10"))
+UPSTREAM_BURST = int(os.getenv("UPSTREAM_BURST", "200"))
+
+# Budget per client (signed-in user or client address), so one user can't spend
+# everyone's quota; large enough for one cold route search
+USER_RATE_PER_SECOND = float(os.getenv("USER_RATE_PER_SECOND", "3"))
+USER_BURST = int(os.getenv("USER_BURST", "300"))
+
+# Request threads allowed to sleep waiting for tokens at once; beyond this calls are
+# rejected straight away so queueing can't tie up the server's threadpool
+MAX_QUEUED_CALLS = int(os.getenv("MAX_QUEUED_CALLS", "8"))
+
+# Optional SQLite file used to share budgets and spend between worker processes
+UPSTREAM_BUDGET_DB = os.getenv("UPSTREAM_BUDGET_DB")
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+PRIORITY_BACKGROUND = 2
+
+# Share of the overall and per-user buckets lower priorities must leave for interactive calls
+PRIORITY_RESERVE = {
+    PRIORITY_INTERACTIVE: 0.0,
+    PRIORITY_BATCH: 0.2,
+    PRIORITY_BACKGROUND: 0.5
+}
+
+# Per-endpoint budgets; deadline is how long one request may queue for tokens in total
+ENDPOINT_BUDGETS = {
+    "trains": {"rate": 10, "burst": 200, "priority": PRIORITY_INTERACTIVE, "deadline": 1},
+    "optimal-route": {"rate": 5, "burst": 150, "priority": PRIORITY_BATCH, "deadline": 10},
+    "live": {"rate": 2, "burst": 40, "priority": PRIORITY_BACKGROUND, "deadline": 5},
+    "route-precompute": {"rate": 2, "burst": 60, "priority": PRIORITY_BACKGROUND, "deadline": 30}
+}
+DEFAULT_BUDGET = {"priority": PRIORITY_INTERACTIVE, "deadline": 1}
+
+# Per-user buckets idle this long have fully refilled and can be forgotten
+IDLE_BUCKET_SECONDS = 600
+
+# Who is spending upstream calls in the current request: (endpoint, user, deadline)
+current_caller = ContextVar("upstream_caller", default=("other", None, None))
+
+
+@contextmanager
+def upstream_caller(endpoint: str, user=None):
+    """
+    Attribute Darwin calls made inside the block to an endpoint and user.
+    """
+    budget = ENDPOINT_BUDGETS.get(endpoint, DEFAULT_BUDGET)
+    token = current_caller.set((endpoint, user, time.time() + budget["deadline"]))
+    try:
+        yield
+    finally:
+        current_caller.reset(token)
+
+
+def caller_limits():
+    """
+    Return the priority and deadline of the current caller.
+    """
+    endpoint, _, deadline = current_caller.get()
+    budget = ENDPOINT_BUDGETS.get(endpoint, DEFAULT_BUDGET)
+    if deadline is None:
+        deadline = time.time() + budget["deadline"]
+    return budget["priority"], deadline
+
+
+def call_as(endpoint: str, fn, user=None):
+    """
+    Run fn attributed to an endpoint, for work started outside a request.
+    """
+    with upstream_caller(endpoint, user):
+        return fn()
+
+
+def refill(tokens, updated, rate, capacity, now):
+    return min(capacity, tokens + max(0.0, now - updated) * rate)
+
+
+class MemoryBucketStore:
+    """
+    Token buckets and spend counters for a single process.
+    """
+    def __init__(self):
+        self.buckets = {}
+        self.spend_counts = defaultdict(lambda: {"calls": 0, "rejected": 0})
+        self.lock = threading.Lock()
+
+    def take(self, buckets, now):
+        """
+        Take one token from every bucket, or none if any is short.
+        Returns 0 on success, otherwise the seconds until all could be satisfied.
+        """
+        with self.lock:
+            levels = []
+            wait = 0.0
+            for name, rate, capacity, reserve in buckets:
+                tokens, updated = self.buckets.get(name, (capacity, now))
+                tokens = refill(tokens, updated, rate, capacity, now)
+                levels.append((name, tokens))
+                if tokens < 1 + reserve:
+                    wait = max(wait, (1 + reserve - tokens) / rate)
+
+            if wait:
+                return wait
+
+            for name, tokens in levels:
+                self.buckets[name] = (tokens - 1, now)
+
+            if len(self.buckets) > 10000:
+                for name in [n for n, (_, updated) in self.buckets.items() if now - updated > IDLE_BUCKET_SECONDS]:
+                    del self.buckets[name]
+            return 0.0
+
+    def give_back(self, buckets, now):
+        """
+        Return one token to every bucket, for calls that were granted but never made.
+        """
+        with self.lock:
+            for name, rate, capacity, _ in buckets:
+                tokens, updated = self.buckets.get(name, (capacity, now))
+                self.buckets[name] = (min(capacity, refill(tokens, updated, rate, capacity, now) + 1), now)
+
+    def record(self, endpoint: str, operation: str, outcome: str):
+        with self.lock:
+            self.spend_counts[(endpoint, operation)][outcome] += 1
+
+    def spend(self):
+        with self.lock:
+            report = {}
+            for (endpoint, operation), counts in self.spend_counts.items():
+                report.setdefault(endpoint, {})[operation] = dict(counts)
+            return report
+
+
+class SqliteBucketStore:
+    """
+    Token buckets and spend counters kept in a local SQLite file, so every worker
+    process on the host draws from the same budgets.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+
+        # Using a throwaway connection so nothing is inherited across forks
+        connection = sqlite3.connect(self.path, timeout=5)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS spend ("
+            "endpoint TEXT, operation TEXT, calls INTEGER DEFAULT 0, rejected INTEGER DEFAULT 0, "
+            "PRIMARY KEY (endpoint, operation))"
+        )
+        connection.commit()
+        connection.close()
+
+    def _connection(self):
+        # One connection per thread and process
+        if getattr(self.local, "pid", None) != os.getpid():
+            self.local.connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def take(self, buckets, now):
+        """
+        Same contract as MemoryBucketStore.take, applied atomically across processes.
+        """
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            levels = []
+            wait = 0.0
+            for name, rate, capacity, reserve in buckets:
+                row = connection.execute("SELECT tokens, updated FROM buckets WHERE name = ?", (name,)).fetchone()
+                tokens, updated = row if row else (capacity, now)
+                tokens = refill(tokens, updated, rate, capacity, now)
+                levels.append((name, tokens))
+                if tokens < 1 + reserve:
+                    wait = max(wait, (1 + reserve - tokens) / rate)
+
+            if not wait:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)",
+                    [(name, tokens - 1, now) for name, tokens in levels]
+                )
+                connection.execute(
+                    "DELETE FROM buckets WHERE name LIKE 'user:%' AND updated < ?",
+                    (now - IDLE_BUCKET_SECONDS,)
+                )
+            connection.execute("COMMIT")
+            return wait
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def give_back(self, buckets, now):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            for name, rate, capacity, _ in buckets:
+                row = connection.execute("SELECT tokens, updated FROM buckets WHERE name = ?", (name,)).fetchone()
+                tokens, updated = row if row else (capacity, now)
+                connection.execute(
+                    "INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)",
+                    (name, min(capacity, refill(tokens, updated, rate, capacity, now) + 1), now)
+                )
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def record(self, endpoint: str, operation: str, outcome: str):
+        column = "calls" if outcome == "calls" else "rejected"
+        self._connection().execute(
+            f"INSERT INTO spend (endpoint, operation, {column}) VALUES (?, ?, 1) "
+            f"ON CONFLICT (endpoint, operation) DO UPDATE SET {column} = {column} + 1",
+            (endpoint, operation)
+        )
+
+    def spend(self):
+        report = {}
+        rows = self._connection().execute("SELECT endpoint, operation, calls, rejected FROM spend").fetchall()
+        for endpoint, operation, calls, rejected in rows:
+            report.setdefault(endpoint, {})[operation] = {"calls": calls, "rejected": rejected}
+        return report
+
+
+class UpstreamGovernor:
+    """
+    Rations Darwin calls with token buckets: one overall, one per endpoint and one per user.
+    Interactive endpoints may drain the overall and per-user buckets; batch and background
+    work must leave a reserve in both, so cheap board lookups keep flowing while route
+    searches queue.
+    """
+    def __init__(self, store=None):
+        if store is None:
+            store = SqliteBucketStore(UPSTREAM_BUDGET_DB) if UPSTREAM_BUDGET_DB else MemoryBucketStore()
+        self.store = store
+        self.queue_slots = threading.BoundedSemaphore(MAX_QUEUED_CALLS)
+
+    def acquire(self, operation: str, queued=None):
+        """
+        Wait for a token for the current caller until its deadline.
+        Returns a grant to pass to spent() or refund(), or None, without waiting,
+        if the budget can't be met in time or too many calls are already queued.
+        queued is an optional Event that is set while the call waits for tokens.
+        """
+        endpoint, user, _ = current_caller.get()
+        budget = ENDPOINT_BUDGETS.get(endpoint, DEFAULT_BUDGET)
+        priority, deadline = caller_limits()
+
+        reserve = PRIORITY_RESERVE[priority]
+        buckets = [("global", UPSTREAM_RATE_PER_SECOND, UPSTREAM_BURST, UPSTREAM_BURST * reserve)]
+        if "rate" in budget:
+            buckets.append((f"endpoint:{endpoint}", budget["rate"], budget["burst"], 0))
+        if user:
+            buckets.append((f"user:{user}", USER_RATE_PER_SECOND, USER_BURST, USER_BURST * reserve))
+
+        # Background work runs on its own threads, so only request threads count as queued
+        counts_as_queued = priority != PRIORITY_BACKGROUND
+        queued_slot = False
+        try:
+            while True:
+                now = time.time()
+                wait = self.store.take(buckets, now)
+                if not wait:
+                    return (endpoint, operation, buckets)
+
+                if now + wait > deadline:
+                    break
+                if counts_as_queued and not queued_slot:
+                    if not self.queue_slots.acquire(blocking=False):
+                        break
+                    queued_slot = True
+                if queued:
+                    queued.set()
+                time.sleep(wait)
+        finally:
+            if queued_slot:
+                self.queue_slots.release()
+            if queued:
+                queued.clear()
+
+        self.store.record(endpoint, operation, "rejected")
+        return None
+
+    def spent(self, grant):
+        """
+        Count a granted call that was actually sent to Darwin.
+        """
+        endpoint, operation, _ = grant
+        self.store.record(endpoint, operation, "calls")
+
+    def refund(self, grant):
+        """
+        Hand back the tokens of a granted call that was shed before reaching Darwin.
+        """
+        endpoint, operation, buckets = grant
+        self.store.give_back(buckets, time.time())
+        self.store.record(endpoint, operation, "rejected")
+
+    def usage(self):
+        """
+        Report upstream calls made and rejected per endpoint and operation.
+        """
+        return {
+            "shared": isinstance(self.store, SqliteBucketStore),
+            "spend": self.store.spend(),
+            "budgets": {
+                "overall": {"rate": UPSTREAM_RATE_PER_SECOND, "burst": UPSTREAM_BURST},
+                "perUser": {"rate": USER_RATE_PER_SECOND, "burst": USER_BURST},
+                "endpoints": ENDPOINT_BUDGETS
+            }
+        }
@@ -0,0 +1,38 @@
+import os
+import sys
+
+import pytest
+import zeep
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# stations.csv and test.db are opened relative to the working directory
+os.chdir(ROOT)
+
+
+class FakeService:
+    """
+    Stand-in for the Darwin SOAP operations; tests replace the methods they need.
+    """
+    def GetDepartureBoard(self, **kwargs):
+        raise AssertionError("GetDepartureBoard not stubbed")
+
+    def GetServiceDetails(self, **kwargs):
+        raise AssertionError("GetServiceDetails not stubbed")
+
+
+class FakeClient:
+    def __init__(self, wsdl=None, transport=None):
+        self.service = FakeService()
+        self.transport = transport
+
+
+# Keeping the WSDL download out of tests; must happen before the fetcher module is imported
+zeep.Client = FakeClient
+
+
+@pytest.fixture
+def fetcher():
+    from services.train_schedule_fetcher import TrainScheduleFetcher
+    return TrainScheduleFetcher()
@@ -0,0 +1,64 @@
+import importlib
+import sys
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import models.database
+import routers.health_routes as health_routes
+
+
+class BrokenEngine:
+    def connect(self):
+        raise ConnectionError("database is down")
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    app.include_router(health_routes.router)
+    return TestClient(app)
+
+
+def test_ready_when_database_and_stations_are_available(client):
+    response = client.get("/health/ready")
+
+    assert response.status_code == 200
+    assert response.json() == {"status": "ok", "checks": {"stations": True, "database": True}}
+
+
+def test_not_ready_when_the_database_is_unreachable(client, monkeypatch):
+    monkeypatch.setattr(health_routes, "engine", BrokenEngine())
+
+    response = client.get("/health/ready")
+
+    assert response.status_code == 503
+    assert response.json() == {"status": "unavailable", "checks": {"stations": True, "database": False}}
+
+
+def test_not_ready_without_station_data(client, monkeypatch):
+    monkeypatch.setattr(health_routes.fetcher, "station_map", {})
+
+    response = client.get("/health/ready")
+
+    assert response.status_code == 503
+    assert response.json()["checks"]["stations"] is False
+
+
+def test_liveness_does_not_depend_on_the_database(client, monkeypatch):
+    monkeypatch.setattr(health_routes, "engine", BrokenEngine())
+
+    assert client.get("/health/live").json() == {"status": "ok"}
+
+
+@pytest.mark.parametrize("skip, created", [("1", False), ("", True)])
+def test_schema_creation_follows_skip_db_init(monkeypatch, skip, created):
+    calls = []
+    monkeypatch.setattr(models.database, "init_db", lambda: calls.append(1))
+    monkeypatch.setenv("SKIP_DB_INIT", skip)
+    monkeypatch.delitem(sys.modules, "main", raising=False)
+
+    importlib.import_module("main")
+
+    assert bool(calls) is created
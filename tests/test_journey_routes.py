@@ -0,0 +1,174 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import routers.journey_routes as journey_routes
+from services.route_cache import RouteCache
+
+
+def board(station, *service_ids):
+    return {
+        "station": station,
+        "departures": [
+            {
+                "serviceID": service_id,
+                "origin": station,
+                "scheduledDeparture": "10:00",
+                "estimatedDeparture": "On time",
+                "platform": "1",
+                "operator": "LNER"
+            }
+            for service_id in service_ids
+        ]
+    }
+
+
+def details(*stops):
+    return {"callingPoints": [
+        {"locationName": crs, "crs": crs, "scheduledTime": time, "estimatedTime": "On time", "actualTime": None, "platform": "1"}
+        for crs, time in stops
+    ]}
+
+
+UNAVAILABLE = {"error": "National Rail request budget exhausted, please try again shortly.", "unavailable": True}
+
+
+class FakeFetcher:
+    def __init__(self, boards, services):
+        self.boards = boards
+        self.services = services
+
+    def resolve_crs(self, station):
+        return station.upper() if len(station) == 3 else None
+
+    def fetch_schedule(self, station):
+        return self.boards.get(station, {"error": f"Station '{station}' not found."})
+
+    def fetch_service_details(self, service_id, **kwargs):
+        return self.services[service_id]
+
+    def board_version(self, crs_code):
+        return 1
+
+    def details_version(self, service_id):
+        return 1
+
+
+@pytest.fixture
+def client_for(monkeypatch):
+    def build(fetcher):
+        cache = RouteCache(fetcher, journey_routes.find_optimal_route)
+        cache._ensure_precompute = lambda: None
+        monkeypatch.setattr(journey_routes, "fetcher", fetcher)
+        monkeypatch.setattr(journey_routes, "route_cache", cache)
+
+        app = FastAPI()
+        app.include_router(journey_routes.router)
+        return TestClient(app), cache
+
+    return build
+
+
+def test_direct_route_is_returned_and_cached(client_for):
+    fetcher = FakeFetcher({"KGX": board("KGX", "S1")}, {"S1": details(("KGX", "10:00"), ("YRK", "11:50"))})
+    client, cache = client_for(fetcher)
+
+    response = client.get("/optimal-route", params={"from": "kgx", "to": "YRK"})
+
+    assert response.status_code == 200
+    assert response.json()["legs"][0]["serviceID"] == "S1"
+    assert cache.get("KGX", "YRK")[0] is True
+
+
+def test_search_cut_short_by_the_budget_returns_its_best_route_uncached(client_for):
+    fetcher = FakeFetcher(
+        {"KGX": board("KGX", "S1", "S2")},
+        {"S1": details(("KGX", "10:00"), ("YRK", "11:50")), "S2": UNAVAILABLE}
+    )
+    client, cache = client_for(fetcher)
+
+    response = client.get("/optimal-route", params={"from": "KGX", "to": "YRK"})
+
+    assert response.status_code == 200
+    assert response.json()["partial"] is True
+    assert response.json()["legs"][0]["serviceID"] == "S1"
+    assert cache.entries == {}
+
+
+class BudgetedFetcher(FakeFetcher):
+    """
+    Answers a fixed number of lookups, then reports every further one as shed by the budget.
+    """
+    def __init__(self, boards, services, budget):
+        super().__init__(boards, services)
+        self.budget = budget
+
+    def fetch_schedule(self, station):
+        self.budget -= 1
+        return super().fetch_schedule(station) if self.budget >= 0 else UNAVAILABLE
+
+    def fetch_service_details(self, service_id, **kwargs):
+        self.budget -= 1
+        return super().fetch_service_details(service_id) if self.budget >= 0 else UNAVAILABLE
+
+
+def test_cold_search_larger_than_the_budget_still_answers(client_for):
+    # Ten departures each calling at a transfer station with its own board and services
+    service_ids = [f"S{i}" for i in range(10)]
+    boards = {"KGX": board("KGX", *service_ids), "PBO": board("PBO", "T1", "T2")}
+    services = {service_id: details(("KGX", "10:00"), ("PBO", "10:45"), ("YRK", "11:50")) for service_id in service_ids}
+    services.update({"T1": details(("PBO", "11:00"), ("YRK", "12:10")), "T2": details(("PBO", "11:30"), ("YRK", "12:40"))})
+    fetcher = BudgetedFetcher(boards, services, budget=12)
+    client, cache = client_for(fetcher)
+
+    response = client.get("/optimal-route", params={"from": "KGX", "to": "YRK"})
+
+    assert response.status_code == 200
+    assert response.json()["partial"] is True
+    assert response.json()["legs"][-1]["arrival"] == "11:50"
+    assert cache.entries == {}
+
+    # With the budget back the full search completes and is cached
+    fetcher.budget = 1000
+    response = client.get("/optimal-route", params={"from": "KGX", "to": "YRK"})
+
+    assert response.status_code == 200
+    assert "partial" not in response.json()
+    assert cache.get("KGX", "YRK")[0] is True
+
+
+def test_rejected_transfer_board_mid_search_is_a_503_and_not_cached(client_for):
+    fetcher = FakeFetcher(
+        {"KGX": board("KGX", "S1"), "PBO": UNAVAILABLE},
+        {"S1": details(("KGX", "10:00"), ("PBO", "10:45"))}
+    )
+    client, cache = client_for(fetcher)
+
+    response = client.get("/optimal-route", params={"from": "KGX", "to": "EDB"})
+
+    assert response.status_code == 503
+    assert cache.entries == {}
+
+
+def test_no_route_is_cached_as_a_404(client_for):
+    fetcher = FakeFetcher({"KGX": board("KGX")}, {})
+    client, cache = client_for(fetcher)
+
+    first = client.get("/optimal-route", params={"from": "KGX", "to": "EDB"})
+    fetcher.boards = {}
+    second = client.get("/optimal-route", params={"from": "KGX", "to": "EDB"})
+
+    assert first.status_code == second.status_code == 404
+    assert cache.stats()["hits"] == 1
+
+
+def test_unknown_station_is_a_400_and_never_reaches_the_cache(client_for):
+    fetcher = FakeFetcher({"KGX": board("KGX", "S1")}, {})
+    client, cache = client_for(fetcher)
+
+    response = client.get("/optimal-route", params={"from": "KGX", "to": "Atlantis"})
+
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Station 'Atlantis' not found."
+    assert cache.pair_counts == {}
+    assert cache.stats()["misses"] == 0
@@ -0,0 +1,110 @@
+import asyncio
+
+from services.live_updates import LiveUpdateHub, diff_calling_points, diff_departures
+
+
+def calling_point(crs, scheduled, estimated="On time", platform="1", cancelled=False):
+    return {
+        "locationName": crs,
+        "crs": crs,
+        "scheduledTime": scheduled,
+        "estimatedTime": estimated,
+        "actualTime": None,
+        "platform": platform,
+        "isCancelled": cancelled
+    }
+
+
+def departure(service_id, estimated="On time", platform="1"):
+    return {"serviceID": service_id, "estimatedDeparture": estimated, "platform": platform, "isCancelled": False}
+
+
+def test_diff_calling_points_returns_only_changed_points():
+    old = {"callingPoints": [calling_point("KGX", "10:00"), calling_point("YRK", "11:50")]}
+    new = {"callingPoints": [calling_point("KGX", "10:00"), calling_point("YRK", "11:50", estimated="11:58")]}
+
+    assert diff_calling_points(old, new) == {"changed": [new["callingPoints"][1]]}
+    assert diff_calling_points(new, new) == {"changed": []}
+
+
+def test_diff_calling_points_reports_cancellations_and_platforms():
+    old = {"callingPoints": [calling_point("YRK", "11:50")]}
+    new = {"callingPoints": [calling_point("YRK", "11:50", platform="5", cancelled=True)]}
+
+    assert diff_calling_points(old, new)["changed"] == new["callingPoints"]
+
+
+def test_diff_departures_reports_added_changed_and_removed():
+    old = {"departures": [departure("A"), departure("B")]}
+    new = {"departures": [departure("B", estimated="10:07"), departure("C")]}
+
+    assert diff_departures(old, new) == {
+        "added": [departure("C")],
+        "changed": [departure("B", estimated="10:07")],
+        "removed": ["A"]
+    }
+
+
+class FakeFetcher:
+    def __init__(self, results):
+        self.results = list(results)
+        self.calls = 0
+
+    def fetch_service_details(self, service_id, fresh=False):
+        self.calls += 1
+        return self.results.pop(0) if len(self.results) > 1 else self.results[0]
+
+
+def drain(queue):
+    messages = []
+    while not queue.empty():
+        messages.append(queue.get_nowait())
+    return messages
+
+
+def test_topic_whose_first_fetch_fails_is_stopped():
+    async def scenario():
+        fetcher = FakeFetcher([{"error": "Unknown service"}])
+        hub = LiveUpdateHub(fetcher, poll_interval=0.01)
+        queue = asyncio.Queue(maxsize=10)
+
+        key = hub.subscribe_service("bogus", queue)
+        await asyncio.sleep(0.1)
+
+        assert key not in hub.topics
+        assert hub.subscriptions_for(queue) == []
+        assert fetcher.calls == 1
+        assert drain(queue)[-1]["unsubscribed"] is True
+
+    asyncio.run(scenario())
+
+
+def test_subscriber_that_misses_an_update_is_resynced_with_a_snapshot():
+    async def scenario():
+        first = {"callingPoints": [calling_point("YRK", "11:50")]}
+        second = {"callingPoints": [calling_point("YRK", "11:50", estimated="11:55")]}
+        third = {"callingPoints": [calling_point("YRK", "11:50", estimated="12:05")]}
+        fetcher = FakeFetcher([first, second, third])
+        hub = LiveUpdateHub(fetcher, poll_interval=0.1)
+        queue = asyncio.Queue(maxsize=1)
+
+        key = hub.subscribe_service("S1", queue)
+        await asyncio.sleep(0.05)
+        assert queue.get_nowait()["type"] == "snapshot"
+
+        # Leaving the queue full so the next update is missed
+        queue.put_nowait({"type": "filler"})
+        await asyncio.sleep(0.1)
+        assert queue in hub.topics[key].out_of_sync
+
+        queue.get_nowait()
+        await asyncio.sleep(0.1)
+        message = queue.get_nowait()
+
+        assert message["type"] == "snapshot"
+        assert message["data"]["callingPoints"][0]["estimatedTime"] == "12:05"
+        assert queue not in hub.topics[key].out_of_sync
+
+        hub.unsubscribe(key, queue)
+
+    asyncio.run(scenario())
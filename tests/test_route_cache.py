@@ -0,0 +1,123 @@
+from fastapi import HTTPException
+
+import services.route_cache as route_cache_module
+from services.route_cache import RouteCache
+
+
+class FakeFetcher:
+    def __init__(self):
+        self.boards = {}
+        self.services = {}
+
+    def resolve_crs(self, station):
+        names = {"london kings cross": "KGX", "york": "YRK"}
+        if len(station) == 3 and station.upper() in ("KGX", "YRK", "EDB"):
+            return station.upper()
+        return names.get(station.lower())
+
+    def board_version(self, crs_code):
+        return self.boards.get(crs_code)
+
+    def details_version(self, service_id):
+        return self.services.get(service_id)
+
+
+def route(from_station="KGX", to_station="YRK", service_id="S1"):
+    return {"type": "direct", "legs": [{"from": from_station, "to": to_station, "serviceID": service_id}]}
+
+
+def make_cache(compute_route=None):
+    fetcher = FakeFetcher()
+    fetcher.boards["KGX"] = 1
+    fetcher.services["S1"] = 1
+    cache = RouteCache(fetcher, compute_route or (lambda f, t: route(f, t)))
+    # Keeping the precompute thread out of unit tests
+    cache._ensure_precompute = lambda: None
+    return cache, fetcher
+
+
+def age_entries(cache, seconds):
+    for key, (cached_at, value, dependencies, ttl) in list(cache.entries.items()):
+        cache.entries[key] = (cached_at - seconds, value, dependencies, ttl)
+
+
+def test_station_spellings_share_one_entry():
+    cache, _ = make_cache()
+
+    assert cache.normalize("kgx") == cache.normalize("London Kings Cross") == "KGX"
+    assert cache.normalize("Atlantis") is None
+    cache.put("KGX", "YRK", route())
+
+    assert cache.get(cache.normalize("london kings cross"), cache.normalize("york")) == (True, route())
+
+
+def test_entry_is_invalidated_when_a_dependency_changes():
+    cache, fetcher = make_cache()
+    cache.put("KGX", "YRK", route())
+
+    fetcher.services["S1"] = 2
+
+    assert cache.get("KGX", "YRK") == (False, None)
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_entry_expires_after_ttl():
+    cache, _ = make_cache()
+    cache.put("KGX", "YRK", route())
+
+    age_entries(cache, route_cache_module.ROUTE_CACHE_TTL_SECONDS)
+
+    assert cache.get("KGX", "YRK") == (False, None)
+
+
+def test_no_route_is_cached_briefly_and_tied_to_the_origin_board():
+    cache, fetcher = make_cache()
+    cache.put("KGX", "EDB", None)
+
+    assert cache.get("KGX", "EDB") == (True, None)
+
+    fetcher.boards["KGX"] = 2
+    assert cache.get("KGX", "EDB") == (False, None)
+
+    cache.put("KGX", "EDB", None)
+    age_entries(cache, route_cache_module.ROUTE_NEGATIVE_TTL_SECONDS)
+    assert cache.get("KGX", "EDB") == (False, None)
+
+
+def test_precompute_skips_entries_that_outlive_the_next_pass():
+    computed = []
+    cache, _ = make_cache(lambda f, t: computed.append((f, t)) or route(f, t))
+
+    cache._precompute([("KGX", "YRK")])
+    cache._precompute([("KGX", "YRK")])
+    assert computed == [("KGX", "YRK")]
+
+    # Recomputed once it would expire before the following pass
+    age_entries(cache, route_cache_module.ROUTE_CACHE_TTL_SECONDS - route_cache_module.ROUTE_PRECOMPUTE_INTERVAL_SECONDS)
+    cache._precompute([("KGX", "YRK")])
+    assert computed == [("KGX", "YRK")] * 2
+
+
+def test_precompute_caches_no_route_and_stops_when_out_of_budget():
+    attempted = []
+
+    def compute(from_station, to_station):
+        attempted.append(to_station)
+        if to_station == "EDB":
+            raise HTTPException(status_code=404, detail="No route")
+        raise HTTPException(status_code=503, detail="Budget exhausted")
+
+    cache, _ = make_cache(compute)
+    cache._precompute([("KGX", "EDB"), ("KGX", "YRK"), ("YRK", "EDB")])
+
+    assert attempted == ["EDB", "YRK"]
+    assert cache.get("KGX", "EDB") == (True, None)
+    assert cache.get("KGX", "YRK") == (False, None)
+
+
+def test_precompute_does_not_cache_partial_routes():
+    cache, _ = make_cache(lambda f, t: {**route(f, t), "partial": True})
+
+    cache._precompute([("KGX", "YRK")])
+
+    assert cache.entries == {}
@@ -0,0 +1,85 @@
+from types import SimpleNamespace
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import routers.train_routes as train_routes
+from services.upstream_governor import MemoryBucketStore, UpstreamGovernor
+
+
+def stub_boards(fetcher):
+    """
+    Answer GetDepartureBoard with empty boards, recording which stations were asked for.
+    """
+    calls = []
+
+    def get_departure_board(crs, **kwargs):
+        calls.append(crs)
+        return SimpleNamespace(trainServices=None, generatedAt="10:00")
+
+    fetcher.client.service.GetDepartureBoard = get_departure_board
+    fetcher.governor = UpstreamGovernor(MemoryBucketStore())
+    return calls
+
+
+@pytest.fixture
+def client(fetcher, monkeypatch):
+    monkeypatch.setattr(train_routes, "fetcher", fetcher)
+    app = FastAPI()
+    app.include_router(train_routes.router)
+    return TestClient(app)
+
+
+def test_duplicate_and_differently_spelled_stations_are_fetched_once(fetcher):
+    calls = stub_boards(fetcher)
+
+    result = fetcher.fetch_boards(["KGX", "kgx", "London Kings Cross", "york"])
+
+    assert sorted(calls) == ["KGX", "YRK"]
+    assert sorted(result["boards"]) == ["KGX", "YRK"]
+    assert result["errors"] == {}
+
+
+def test_unknown_stations_are_reported_under_the_given_name(fetcher):
+    stub_boards(fetcher)
+
+    result = fetcher.fetch_boards(["KGX", "Atlantis"])
+
+    assert list(result["boards"]) == ["KGX"]
+    assert result["errors"] == {"Atlantis": "Station 'Atlantis' not found."}
+
+
+def test_unavailable_station_is_a_per_station_error(client, fetcher, monkeypatch):
+    stub_boards(fetcher)
+    unavailable = {"error": "National Rail is busy, please try again shortly.", "unavailable": True}
+    monkeypatch.setattr(
+        fetcher, "_fetch_board",
+        lambda crs_code, *args: unavailable if crs_code == "YRK" else {"station": crs_code, "departures": []}
+    )
+
+    response = client.get("/trains/boards", params={"crs": "KGX,YRK"})
+
+    assert response.status_code == 200
+    assert list(response.json()["boards"]) == ["KGX"]
+    assert response.json()["errors"] == {"YRK": unavailable["error"]}
+
+
+def test_too_many_stations_is_a_400(client):
+    stations = ",".join(["KGX"] * (train_routes.MAX_BOARD_STATIONS + 1))
+
+    response = client.get("/trains/boards", params={"crs": stations})
+
+    assert response.status_code == 400
+
+
+def test_malformed_live_messages_get_an_error_and_keep_the_socket_open(client):
+    with client.websocket_connect("/trains/live") as websocket:
+        websocket.send_bytes(b"\x00\x01")
+        assert websocket.receive_json() == {"type": "error", "detail": "Messages must be JSON text."}
+
+        websocket.send_text("not json")
+        assert websocket.receive_json() == {"type": "error", "detail": "Messages must be JSON text."}
+
+        websocket.send_json({"action": "subscribe"})
+        assert websocket.receive_json()["detail"] == "Expected a 'service' or 'station' to watch."
@@ -0,0 +1,149 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import services.train_schedule_fetcher as fetcher_module
+import services.upstream_governor as governor_module
+from services.upstream_governor import MemoryBucketStore, UpstreamGovernor, call_as, upstream_caller
+
+
+def aged(result, seconds, version=1):
+    return (time.monotonic() - seconds, result, version)
+
+
+def test_fresh_entry_is_served_without_calling_the_loader(fetcher):
+    cache = {"KGX": aged({"departures": [1]}, 5)}
+
+    result = fetcher.fetch_cached(cache, "KGX", 30, lambda: pytest.fail("loader called"))
+
+    assert result == {"departures": [1]}
+
+
+def test_expired_entry_is_served_stale_and_refreshed_once(fetcher):
+    cache = {"KGX": aged({"departures": [1]}, 40)}
+    release = threading.Event()
+    calls = []
+
+    def loader():
+        calls.append(1)
+        release.wait(1)
+        return {"departures": [2]}
+
+    first = fetcher.fetch_cached(cache, "KGX", 30, loader)
+    second = fetcher.fetch_cached(cache, "KGX", 30, loader)
+    release.set()
+    fetcher.refresh_executor.shutdown(wait=True)
+
+    assert first["stale"] is True and first["ageSeconds"] == 40
+    assert second["departures"] == [1]
+    assert calls == [1]
+    assert cache["KGX"][1] == {"departures": [2]}
+
+
+def test_failed_fetch_falls_back_to_last_good_result(fetcher):
+    cache = {"KGX": aged({"departures": [1]}, 40)}
+
+    result = fetcher.fetch_cached(cache, "KGX", 30, lambda: {"error": "boom"}, fresh=True)
+
+    assert result == {"departures": [1], "stale": True, "ageSeconds": 40}
+
+
+def test_failed_fetch_without_cache_returns_the_error(fetcher):
+    result = fetcher.fetch_cached({}, "KGX", 30, lambda: {"error": "boom", "unavailable": True})
+
+    assert result == {"error": "boom", "unavailable": True}
+
+
+def test_too_old_entry_is_not_served(fetcher):
+    cache = {"KGX": aged({"departures": [1]}, fetcher_module.STALE_MAX_AGE_SECONDS + 1)}
+
+    result = fetcher.fetch_cached(cache, "KGX", 30, lambda: {"error": "boom"})
+
+    assert result == {"error": "boom"}
+
+
+def test_concurrent_misses_share_one_loader_call(fetcher):
+    cache = {}
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def loader():
+        calls.append(1)
+        started.set()
+        release.wait(1)
+        return {"departures": [1]}
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(fetcher.fetch_cached(cache, "KGX", 30, loader)))
+    leader.start()
+    started.wait(1)
+    followers = [
+        threading.Thread(target=lambda: results.append(fetcher.fetch_cached(cache, "KGX", 30, loader)))
+        for _ in range(5)
+    ]
+    for thread in followers:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join()
+
+    assert calls == [1]
+    assert results == [{"departures": [1]}] * 6
+    assert fetcher.in_flight == {}
+
+
+def test_version_changes_only_when_content_changes(fetcher):
+    fetcher._store(fetcher.details_cache, "S1", {"generatedAt": "10:00", "callingPoints": [1]})
+    first = fetcher.details_version("S1")
+
+    fetcher._store(fetcher.details_cache, "S1", {"generatedAt": "10:01", "callingPoints": [1]})
+    assert fetcher.details_version("S1") == first
+
+    fetcher._store(fetcher.details_cache, "S1", {"generatedAt": "10:02", "callingPoints": [2]})
+    assert fetcher.details_version("S1") != first
+
+
+def wait_for(condition, timeout=1):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not met in time"
+        time.sleep(0.01)
+
+
+def test_interactive_caller_does_not_wait_behind_a_fetch_queued_for_budget(fetcher):
+    store = MemoryBucketStore()
+    store.buckets["global"] = (0.0, time.time())
+    fetcher.governor = UpstreamGovernor(store)
+    fetcher.client.service.GetDepartureBoard = lambda **kwargs: SimpleNamespace(trainServices=None, generatedAt="10:00")
+
+    # Precompute must leave half the overall bucket, so it queues for about ten seconds
+    threading.Thread(
+        target=call_as, args=("route-precompute", lambda: fetcher.fetch_schedule("KGX")), daemon=True
+    ).start()
+    wait_for(lambda: any(flight.queued.is_set() for flight in list(fetcher.in_flight.values())))
+
+    started = time.monotonic()
+    with upstream_caller("trains"):
+        result = fetcher.fetch_schedule("KGX")
+
+    assert result["departures"] == []
+    assert time.monotonic() - started < 1
+
+
+def test_waiting_on_a_queued_fetch_is_capped_at_the_callers_deadline(fetcher, monkeypatch):
+    monkeypatch.setitem(governor_module.ENDPOINT_BUDGETS["trains"], "deadline", 0.2)
+    cache = {}
+
+    with upstream_caller("trains"):
+        flight, _ = fetcher._join_flight(cache, "KGX")
+        flight.queued.set()
+
+        started = time.monotonic()
+        result = fetcher.fetch_cached(cache, "KGX", 30, lambda: pytest.fail("loader called"))
+
+    assert result["unavailable"] is True
+    assert time.monotonic() - started < 0.5
@@ -0,0 +1,183 @@
+import time
+
+import pytest
+
+import services.upstream_governor as governor_module
+from services.upstream_governor import (
+    MemoryBucketStore,
+    SqliteBucketStore,
+    UpstreamGovernor,
+    upstream_caller
+)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryBucketStore()
+    return SqliteBucketStore(str(tmp_path / "budget.db"))
+
+
+def test_take_spends_the_burst_then_reports_the_wait(store):
+    buckets = [("global", 2.0, 3, 0)]
+    now = 1000.0
+
+    assert [store.take(buckets, now) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert store.take(buckets, now) == pytest.approx(0.5)
+    assert store.take(buckets, now + 0.5) == 0.0
+
+
+def test_take_is_all_or_nothing_across_buckets(store):
+    plenty = ("global", 1.0, 10, 0)
+    empty = ("user:a", 1.0, 1, 0)
+    now = 1000.0
+
+    assert store.take([plenty, empty], now) == 0.0
+    assert store.take([plenty, empty], now) == pytest.approx(1.0)
+
+    # The refused call took nothing from the bucket that had tokens
+    assert [store.take([plenty], now) for _ in range(9)] == [0.0] * 9
+    assert store.take([plenty], now) > 0
+
+
+def test_reserve_is_left_for_higher_priorities(store):
+    now = 1000.0
+    background = [("global", 1.0, 10, 5)]
+    interactive = [("global", 1.0, 10, 0)]
+
+    granted = 0
+    while store.take(background, now) == 0.0:
+        granted += 1
+
+    assert granted == 5
+    assert store.take(interactive, now) == 0.0
+
+
+def test_give_back_returns_a_token(store):
+    buckets = [("global", 1.0, 1, 0)]
+    now = 1000.0
+
+    assert store.take(buckets, now) == 0.0
+    assert store.take(buckets, now) > 0
+    store.give_back(buckets, now)
+    assert store.take(buckets, now) == 0.0
+
+
+def test_sqlite_store_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / "budget.db")
+    first, second = SqliteBucketStore(path), SqliteBucketStore(path)
+    buckets = [("global", 1.0, 2, 0)]
+    now = 1000.0
+
+    assert first.take(buckets, now) == 0.0
+    assert second.take(buckets, now) == 0.0
+    assert first.take(buckets, now) > 0
+
+    first.record("trains", "GetDepartureBoard", "calls")
+    second.record("trains", "GetDepartureBoard", "rejected")
+    assert first.spend() == {"trains": {"GetDepartureBoard": {"calls": 1, "rejected": 1}}}
+
+
+def test_acquire_rejects_without_sleeping_when_the_deadline_cant_be_met(monkeypatch):
+    monkeypatch.setattr(governor_module, "USER_BURST", 1)
+    monkeypatch.setattr(governor_module, "USER_RATE_PER_SECOND", 0.01)
+    governor = UpstreamGovernor(MemoryBucketStore())
+
+    with upstream_caller("trains", user="ip:1.2.3.4"):
+        grant = governor.acquire("GetDepartureBoard")
+        started = time.monotonic()
+        assert governor.acquire("GetDepartureBoard") is None
+
+    assert time.monotonic() - started < 0.1
+    governor.spent(grant)
+    assert governor.usage()["spend"] == {"trains": {"GetDepartureBoard": {"calls": 1, "rejected": 1}}}
+
+
+def test_batch_calls_leave_part_of_the_user_budget_for_interactive_calls(monkeypatch):
+    monkeypatch.setattr(governor_module, "USER_BURST", 10)
+    monkeypatch.setattr(governor_module, "USER_RATE_PER_SECOND", 0.01)
+    governor = UpstreamGovernor(MemoryBucketStore())
+
+    with upstream_caller("optimal-route", user="ip:1.2.3.4"):
+        route_grants = 0
+        while governor.acquire("GetServiceDetails"):
+            route_grants += 1
+
+    with upstream_caller("trains", user="ip:1.2.3.4"):
+        assert governor.acquire("GetDepartureBoard") is not None
+
+    assert route_grants == 8
+
+
+def test_queueing_is_rejected_once_all_queue_slots_are_taken(monkeypatch):
+    monkeypatch.setattr(governor_module, "USER_BURST", 1)
+    monkeypatch.setattr(governor_module, "USER_RATE_PER_SECOND", 2)
+    governor = UpstreamGovernor(MemoryBucketStore())
+    for _ in range(governor_module.MAX_QUEUED_CALLS):
+        governor.queue_slots.acquire()
+
+    with upstream_caller("trains", user="ip:1.2.3.4"):
+        assert governor.acquire("GetDepartureBoard") is not None
+        # Would only need a 0.5s wait, but no thread may queue
+        assert governor.acquire("GetDepartureBoard") is None
+
+
+def test_refund_returns_tokens_and_counts_a_rejection(monkeypatch):
+    monkeypatch.setattr(governor_module, "USER_BURST", 1)
+    monkeypatch.setattr(governor_module, "USER_RATE_PER_SECOND", 0.01)
+    governor = UpstreamGovernor(MemoryBucketStore())
+
+    with upstream_caller("trains", user="ip:1.2.3.4"):
+        governor.refund(governor.acquire("GetDepartureBoard"))
+        assert governor.acquire("GetDepartureBoard") is not None
+
+    assert governor.usage()["spend"] == {"trains": {"GetDepartureBoard": {"calls": 0, "rejected": 1}}}
+
+
+def test_call_shed_by_the_concurrency_limit_is_refunded(fetcher):
+    fetcher.governor = UpstreamGovernor(MemoryBucketStore())
+    while fetcher.upstream_slots.acquire(blocking=False):
+        pass
+
+    result = fetcher._fetch_board("KGX")
+
+    assert result["unavailable"] is True
+    assert fetcher.governor.usage()["spend"] == {"other": {"GetDepartureBoard": {"calls": 0, "rejected": 1}}}
+
+
+def make_request(headers=None, client=("203.0.113.7", 5000)):
+    from starlette.requests import Request
+    return Request({
+        "type": "http",
+        "headers": [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+        "client": client
+    })
+
+
+def test_caller_identity_prefers_the_signed_in_user():
+    from utils.auth import create_access_token
+    from utils.upstream import caller_identity
+
+    token = create_access_token({"sub": "alice"})
+
+    assert caller_identity(make_request({"Authorization": f"Bearer {token}"})) == "account:alice"
+    assert caller_identity(make_request({"Authorization": "Bearer not-a-token"})) == "ip:203.0.113.7"
+    assert caller_identity(make_request(client=None)) is None
+
+
+def test_caller_address_ignores_forwarded_entries_the_client_wrote(monkeypatch):
+    import utils.upstream as upstream_module
+    from utils.upstream import caller_identity
+
+    spoofed = {"X-Forwarded-For": "198.51.100.9, 192.0.2.44"}
+
+    # Without a proxy the header is ignored entirely
+    assert caller_identity(make_request(spoofed)) == "ip:203.0.113.7"
+
+    # Behind one proxy only the entry it appended is used, not the client's leftmost one
+    monkeypatch.setattr(upstream_module, "TRUSTED_PROXY_HOPS", 1)
+    assert caller_identity(make_request(spoofed)) == "ip:192.0.2.44"
+    assert caller_identity(make_request({"X-Forwarded-For": "192.0.2.44"})) == "ip:192.0.2.44"
+
+    # A request that didn't come through the proxy falls back to the connecting address
+    assert caller_identity(make_request()) == "ip:203.0.113.7"
@@ -0,0 +1,48 @@
+import os
+from fastapi import HTTPException, Request
+from services.train_schedule_fetcher import UPSTREAM_RETRY_AFTER_SECONDS
+from utils.auth import decode_token
+
+# Proxies in front of the app that each append the address they saw to X-Forwarded-For
+# (1 behind Render). Entries left of theirs are written by the client and never trusted.
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "0"))
+
+def raise_if_unavailable(result):
+    # Failing fast with a 503 when Darwin is shedding load or timing out and nothing is cached
+    if result.get("unavailable"):
+        raise HTTPException(
+            status_code=503,
+            detail=result["error"],
+            headers={"Retry-After": str(UPSTREAM_RETRY_AFTER_SECONDS)}
+        )
+    return result
+
+def client_address(request: Request):
+    """
+    Return the address of the client, as recorded by the outermost trusted proxy.
+    """
+    if TRUSTED_PROXY_HOPS:
+        hops = [
+            hop.strip()
+            for header in request.headers.getlist("x-forwarded-for")
+            for hop in header.split(",")
+            if hop.strip()
+        ]
+        if len(hops) >= TRUSTED_PROXY_HOPS:
+            return hops[-TRUSTED_PROXY_HOPS]
+
+    return request.client.host if request.client else None
+
+def caller_identity(request: Request):
+    """
+    Identify who is spending upstream budget: the signed-in user if a valid token
+    is sent, otherwise the client address.
+    """
+    authorization = request.headers.get("Authorization", "")
+    if authorization.lower().startswith("bearer "):
+        payload = decode_token(authorization[7:])
+        if payload and payload.get("sub"):
+            return f"account:{payload['sub']}"
+
+    address = client_address(request)
+    return f"ip:{address}" if address else None